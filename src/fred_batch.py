@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import fred_fuzzy
+
+import itertools
+import multiprocessing
+import queue
+import random
+import sys
+import traceback
+import zlib
+
+
+######################################################################
+## batch replies
+## replay many (session, utterance) pairs, e.g. from logs, sharing the
+## tokenising and matching across repeated utterances
+######################################################################
+
+class BatchReplier (object):
+    memo_size = 100000
+
+    def __init__ (self, rules, seed=None):
+        self.rules = rules
+        self.seed = seed
+        self.sessions = {}
+        self.memo = {}
+        self.fuzzy_union = fred_fuzzy.FuzzyUnion()
+
+
+    def get_session (self, key):
+        """
+        return the session for a key, starting the conversation the first
+        time; with a seed, each session gets its own generator derived
+        from the seed and the key, so replies do not depend on how the
+        batch gets split up
+        """
+
+        session = self.sessions.get(key)
+
+        if session is None:
+            if self.seed is None:
+                rng = random.Random()
+            else:
+                rng = random.Random("%s/%s" % (self.seed, key))
+
+            session = self.rules.new_session(rng)
+            self.rules.choose_first(session)
+            self.sessions[key] = session
+
+        return session
+
+
+    def match (self, utterance):
+        """
+        tokenise and match an utterance, remembering the result for the
+        next time the same utterance comes along
+        """
+
+        matched = self.memo.get(utterance)
+
+        if matched is None:
+            if len(self.memo) >= self.memo_size:
+                self.memo.clear()
+
+            stimulus = self.rules.lang.parse(utterance)
+            matched = (stimulus, self.rules.match_stimulus(stimulus))
+            self.memo[utterance] = matched
+
+        return matched
+
+
+    def reply (self, key, utterance):
+        session = self.get_session(key)
+        stimulus, candidates = self.match(utterance)
+        candidates = self.rules.get_expected(session, stimulus) or candidates
+        response, selected_rule, weight = self.rules.reply(session, stimulus, candidates, self.fuzzy_union)
+
+        return response, selected_rule.name, weight
+
+
+    def reply_all (self, pairs):
+        return [self.reply(key, utterance) for key, utterance in pairs]
+
+
+def get_partition (key, processes):
+    """
+    a stable mapping from session key to worker, so that each session's
+    turns all land in the same process, in order
+    """
+
+    return zlib.crc32(repr(key).encode("utf-8")) % processes
+
+
+def batch_worker (rules, seed, in_queue, out_queue):
+    """
+    reply to chunks until told to stop, sending back (error, replies)
+    for each one; a failure gets sent back as its traceback, for the
+    parent to raise
+    """
+
+    try:
+        replier = BatchReplier(rules, seed)
+
+        for chunk in iter(in_queue.get, None):
+            out_queue.put((None, [(i, replier.reply(key, utterance)) for i, key, utterance in chunk]))
+    except Exception:
+        out_queue.put((traceback.format_exc(), None))
+
+
+def get_replies (out_queue, workers, poll_interval=1.0):
+    """
+    wait for a worker's replies, raising RuntimeError if a worker has
+    failed, or has died without a word
+    """
+
+    while True:
+        try:
+            error, replies = out_queue.get(timeout=poll_interval)
+        except queue.Empty:
+            for worker in workers:
+                if not worker.is_alive():
+                    raise RuntimeError("batch worker %d died, with exit code %s" % (worker.pid, worker.exitcode))
+
+            continue
+
+        if error:
+            raise RuntimeError("batch worker failed:\n" + error)
+
+        return replies
+
+
+def reply_batch (rules, pairs, seed=None, processes=None, chunk_size=10000):
+    """
+    yield a (response, rule name, weight) reply for each (session key,
+    utterance) pair, in order; with processes > 1 the sessions get
+    spread across that many worker processes
+    """
+
+    if not processes or processes < 2:
+        replier = BatchReplier(rules, seed)
+
+        for key, utterance in pairs:
+            yield replier.reply(key, utterance)
+
+        return
+
+    # each worker keeps its own sessions, so it gets a dedicated queue
+    # rather than taking whatever work a pool would hand it
+
+    out_queue = multiprocessing.Queue()
+    in_queues = [multiprocessing.Queue() for i in range(processes)]
+    workers = [multiprocessing.Process(target=batch_worker, args=(rules, seed, q, out_queue), daemon=True) for q in in_queues]
+
+    for worker in workers:
+        worker.start()
+
+    finished = False
+
+    try:
+        pairs = iter(pairs)
+
+        while True:
+            chunk = list(itertools.islice(pairs, chunk_size))
+
+            if not chunk:
+                break
+
+            parts = [[] for i in range(processes)]
+
+            for i, (key, utterance) in enumerate(chunk):
+                parts[get_partition(key, processes)].append((i, key, utterance))
+
+            sent = 0
+
+            for q, part in zip(in_queues, parts):
+                if part:
+                    q.put(part)
+                    sent += 1
+
+            replies = [None] * len(chunk)
+
+            for n in range(sent):
+                for i, reply in get_replies(out_queue, workers):
+                    replies[i] = reply
+
+            for reply in replies:
+                yield reply
+
+        finished = True
+    finally:
+        if finished:
+            for q in in_queues:
+                q.put(None)
+
+            for worker in workers:
+                worker.join()
+        else:
+            stop_workers(workers, [out_queue] + in_queues)
+
+
+def stop_workers (workers, queues, timeout=5.0):
+    """
+    stop the workers of a batch which has failed, or been abandoned:
+    they may be blocked sending back replies nobody will read, so they
+    cannot be asked to finish
+    """
+
+    for worker in workers:
+        worker.terminate()
+
+    for worker in workers:
+        worker.join(timeout)
+
+        if worker.is_alive():
+            worker.kill()
+            worker.join()
+
+    # nor should this process wait to flush work to them at exit
+    for q in queues:
+        q.cancel_join_thread()
+
+
+if __name__=='__main__':
+    import fred_cache
+    import fred_lang
+
+    ## replay a log of tab-separated session key, utterance lines
+    rules = fred_cache.load_rules(fred_lang.Language(), sys.argv[1])
+
+    with open(sys.argv[2], "r") as f:
+        pairs = (line.rstrip("\n").split("\t", 1) for line in f if "\t" in line)
+
+        for response, rule_name, weight in reply_batch(rules, pairs, seed=0):
+            print(rule_name, weight, response, sep="\t")
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import fred_cache
+import fred_lang
+import fred_rules
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+
+
+######################################################################
+## benchmarks
+## time rule loading, indexing, tokenising and replies over synthetic
+## rulebases of increasing size
+######################################################################
+
+class RulebaseGenerator (object):
+    syllables = [ "ba", "ko", "ri", "ne", "tu", "la", "mi", "so", "dre", "fan", "gul", "pex" ]
+
+    def __init__ (self, seed):
+        self.rng = random.Random(seed)
+
+
+    def make_word (self, max_syllables=4):
+        return "".join(self.rng.choice(self.syllables) for i in range(self.rng.randint(2, max_syllables)))
+
+
+    def make_vocab (self, size):
+        vocab = set()
+        max_syllables = 4
+
+        # allow longer words until there are plenty more to draw from
+        # than are needed
+        while sum(len(self.syllables) ** n for n in range(2, max_syllables + 1)) < size * 4:
+            max_syllables += 1
+
+        while len(vocab) < size:
+            vocab.add(self.make_word(max_syllables))
+
+        return sorted(vocab)
+
+
+    def make_phrase (self, vocab, min_len=1, max_len=3):
+        return " ".join(self.rng.choice(vocab) for i in range(self.rng.randint(min_len, max_len)))
+
+
+    def write (self, f, num_actions):
+        """
+        write a synthetic rulebase in the jfred.dat format, with one
+        regex rule and roughly half a fuzzy rule per action rule
+        """
+
+        rng = self.rng
+        vocab = self.make_vocab(max(200, num_actions * 2))
+        actions = ["ACT%d" % i for i in range(num_actions)]
+        phrases = []
+
+        f.write("### synthetic JFRED rulebase, %d action rules\n\n" % num_actions)
+        f.write("intro:\tINTRO1\n\tLook,\n\tWell,\n\n")
+
+        for name in actions:
+            f.write("action:\t%s\n" % name)
+            f.write("\tpriority: %d\n" % rng.randint(0, 10))
+
+            if rng.random() < 0.15:
+                f.write("\trepeat: true\n")
+
+            if rng.random() < 0.1:
+                f.write("\tbind: %s\n" % rng.choice(vocab))
+                f.write("\tSo you say [], do you?\n")
+
+            for i in range(rng.randint(1, 6)):
+                f.write("\t%s.\n" % self.make_phrase(vocab, 3, 10).capitalize())
+
+            f.write("\n")
+
+        for i, name in enumerate(actions):
+            invokes = " ".join(rng.sample(actions, min(len(actions), rng.randint(1, 2))))
+            f.write("regex:\tREGEX%d\n\tinvokes: %s\n" % (i, invokes))
+
+            for j in range(rng.randint(1, 5)):
+                phrase = self.make_phrase(vocab)
+                phrases.append(phrase)
+                f.write("\t%s\n" % phrase)
+
+            f.write("\n")
+
+        for term in rng.sample(vocab, num_actions // 2):
+            f.write("fuzzy:\t%s\n" % term.upper())
+
+            for name in rng.sample(actions, min(len(actions), rng.randint(1, 4))):
+                f.write("\t%d\t%s\n" % (rng.randint(1, 100), name))
+
+            f.write("\n")
+
+        return vocab, phrases
+
+
+    def make_utterances (self, vocab, phrases, count):
+        """
+        mostly utterances with a known phrase somewhere in them, plus some
+        which only ever reach the fallback rules
+        """
+
+        rng = self.rng
+        utterances = []
+
+        for i in range(count):
+            words = [rng.choice(vocab) for j in range(rng.randint(0, 8))]
+
+            if phrases and rng.random() < 0.8:
+                words.insert(rng.randint(0, len(words)), rng.choice(phrases))
+
+            utterances.append(" ".join(words) + rng.choice(["", ".", "?", "!"]))
+
+        return utterances
+
+
+def get_percentile (samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def summarise (samples):
+    """
+    latency percentiles in microseconds, plus throughput per second
+    """
+
+    total = sum(samples)
+
+    return { "count": len(samples),
+             "p50_us": get_percentile(samples, 0.50) * 1e6,
+             "p99_us": get_percentile(samples, 0.99) * 1e6,
+             "mean_us": total / len(samples) * 1e6,
+             "per_sec": len(samples) / total if total else None
+             }
+
+
+def time_once (func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def run_size (num_actions, turns, seed, tmp_dir):
+    gen = RulebaseGenerator(seed)
+    filename = os.path.join(tmp_dir, "bench_%d.dat" % num_actions)
+
+    with open(filename, "w") as f:
+        vocab, phrases = gen.write(f, num_actions)
+
+    utterances = gen.make_utterances(vocab, phrases, turns)
+    lang = fred_lang.Language()
+    result = { "actions": num_actions, "file_bytes": os.path.getsize(filename) }
+
+    # load: parse and index separately, then peak memory of the whole
+
+    gc.collect()
+    parse_time, (rule_dict, first_action, fuzzy_dict) = time_once(fred_rules.Rule.read_file, filename)
+    index_time, rules = time_once(fred_rules.Rules, lang, rule_dict, first_action, fuzzy_dict)
+
+    result["parse_file_s"] = parse_time
+    result["rules_init_s"] = index_time
+    result["rules"] = len(rule_dict) + len(fuzzy_dict)
+
+    del rules, rule_dict, fuzzy_dict
+    gc.collect()
+    tracemalloc.start()
+    rules = fred_rules.Rule.parse_file(lang, filename)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result["loaded_bytes"] = current
+    result["load_peak_bytes"] = peak
+
+    # time to the first reply from a cold start, parsing the rule file
+    # or loading its compiled cache
+
+    fred_cache.RuleCache(filename).save(rules)
+
+    for use_cache, key in [(False, "first_reply_s"), (True, "cached_first_reply_s")]:
+        gc.collect()
+        start = time.perf_counter()
+        cold = fred_cache.load_rules(fred_lang.Language(), filename, use_cache)
+        session = cold.new_session(random.Random(seed))
+        cold.choose_first(session)
+        cold.choose_rule(session, utterances[0])
+        result[key] = time.perf_counter() - start
+        del cold, session
+
+    # tokenise and reply, one timing per call
+
+    perf_counter = time.perf_counter
+    samples = []
+
+    for utterance in utterances:
+        start = perf_counter()
+        lang.parse(utterance)
+        samples.append(perf_counter() - start)
+
+    result["language_parse"] = summarise(samples)
+
+    session = rules.new_session(random.Random(seed))
+    rules.choose_first(session)
+    samples = []
+
+    for utterance in utterances:
+        start = perf_counter()
+        rules.choose_rule(session, utterance)
+        samples.append(perf_counter() - start)
+
+    result["choose_rule"] = summarise(samples)
+
+    return result
+
+
+def compare (current, previous):
+    """
+    print how each timing moved against an earlier run
+    """
+
+    before = dict((r["actions"], r) for r in previous["results"])
+
+    for r in current["results"]:
+        old = before.get(r["actions"])
+
+        if not old:
+            continue
+
+        print("actions=%d" % r["actions"])
+
+        for key in ["parse_file_s", "rules_init_s", "load_peak_bytes", "first_reply_s", "cached_first_reply_s"]:
+            if old.get(key):
+                print("  %-24s %8.2fx" % (key, r[key] / old[key]))
+
+        for key in ["language_parse", "choose_rule"]:
+            if key in old:
+                for stat in ["p50_us", "p99_us"]:
+                    print("  %-24s %8.2fx" % (key + "." + stat, r[key][stat] / old[key][stat]))
+
+
+def main ():
+    parser = argparse.ArgumentParser(description="benchmark the JFRED engine")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="number of action rules per synthetic rulebase")
+    parser.add_argument("--turns", type=int, default=5000, help="utterances to reply to, per rulebase")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the rulebases, utterances and replies")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against the results in this JSON file")
+    args = parser.parse_args()
+
+    report = { "python": platform.python_version(),
+               "platform": platform.platform(),
+               "seed": args.seed,
+               "turns": args.turns,
+               "results": []
+               }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            result = run_size(size, args.turns, args.seed, tmp_dir)
+            report["results"].append(result)
+
+            print("actions=%-7d parse %.3fs  index %.3fs  peak %.1fMB  first reply %.3fs (cached %.3fs)  parse p50 %.1fus  reply p50 %.1fus p99 %.1fus  %.0f replies/s" % (
+                size, result["parse_file_s"], result["rules_init_s"], result["load_peak_bytes"] / 1e6,
+                result["first_reply_s"], result["cached_first_reply_s"],
+                result["language_parse"]["p50_us"],
+                result["choose_rule"]["p50_us"], result["choose_rule"]["p99_us"], result["choose_rule"]["per_sec"]
+                ))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(report, json.load(f))
+
+
+if __name__=='__main__':
+    main()
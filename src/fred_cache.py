@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import fred_rules
+
+import hashlib
+import os
+import pickle
+import sys
+
+
+######################################################################
+## compiled rulebase cache
+## a versioned binary image of the parsed rules and their indexes,
+## stored next to the rule file and reused while the source matches
+######################################################################
+
+class RuleCache (object):
+    magic = b"PYFRED"
+    version = 10
+    suffix = ".cache"
+
+    def __init__ (self, filename, cache_file=None):
+        self.filename = filename
+        self.cache_file = cache_file or filename + RuleCache.suffix
+
+
+    def get_digest (self):
+        h = hashlib.sha1()
+
+        with open(self.filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+
+        return h.hexdigest()
+
+
+    def read_header (self, f):
+        """
+        read the header of a cache file, or None if it was written by a
+        different format version
+        """
+
+        if f.read(len(RuleCache.magic)) != RuleCache.magic:
+            return None
+
+        header = pickle.load(f)
+
+        if header.get("version") != RuleCache.version:
+            return None
+
+        return header
+
+
+    def load (self):
+        """
+        return the cached Rules, or None if the cache is missing or stale
+        """
+
+        try:
+            stat = os.stat(self.filename)
+
+            with open(self.cache_file, "rb") as f:
+                header = self.read_header(f)
+
+                if not header or header["size"] != stat.st_size:
+                    return None
+
+                if header["mtime"] != stat.st_mtime_ns:
+                    # touched, but perhaps not changed
+                    if header["digest"] != self.get_digest():
+                        return None
+
+                return pickle.load(f)
+
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError, AttributeError):
+            return None
+
+
+    def save (self, rules):
+        """
+        write the cache atomically, so that concurrent readers only ever
+        see a complete file
+        """
+
+        stat = os.stat(self.filename)
+        header = { "version": RuleCache.version,
+                   "size": stat.st_size,
+                   "mtime": stat.st_mtime_ns,
+                   "digest": self.get_digest()
+                   }
+
+        tmp_file = "%s.%d.tmp" % (self.cache_file, os.getpid())
+
+        try:
+            with open(tmp_file, "wb") as f:
+                f.write(RuleCache.magic)
+                pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(rules, f, pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            print("WARNING: cannot write rule cache", self.cache_file, e, file=sys.stderr)
+
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+def load_rules (lang, filename, use_cache=True, processes=None, progress=None):
+    """
+    read a JFRED rule file through its compiled cache, rebuilding the
+    cache whenever the rule file has changed; NB: cached rules keep the
+    Language they were compiled with
+    """
+
+    if not use_cache:
+        return fred_rules.Rule.parse_file(lang, filename, processes, progress)
+
+    cache = RuleCache(filename)
+    rules = cache.load()
+
+    if rules is None:
+        rules = fred_rules.Rule.parse_file(lang, filename, processes, progress)
+        cache.save(rules)
+
+    return rules
+
+
+if __name__=='__main__':
+    import fred_lang
+
+    rules = fred_rules.Rule.parse_file(fred_lang.Language(), sys.argv[1])
+    RuleCache(sys.argv[1]).save(rules)
@@ -17,7 +17,12 @@
 ## limitations under the License.
 
 
+import fred_rules
+
+import itertools
+import random
 import socket
+import time
 
 
 ######################################################################
@@ -28,6 +33,9 @@ class Convo (object):
     def converse (self, response):
         return input(response)
 
+    def say (self, text):
+        print(text)
+
 
 class TCPConvo (Convo):
     max_line_size = 1024
@@ -36,17 +44,107 @@ class TCPConvo (Convo):
         self.client = client
 
     def converse (self, response):
-        self.client.send(response)
-        return self.client.recv(max_line_size)
+        self.client.sendall(response.encode("utf-8"))
+        return self.client.recv(self.max_line_size).decode("utf-8", "replace").strip()
+
+    def say (self, text):
+        self.client.sendall((text + "\n").encode("utf-8"))
 
 
 class FRED (object):
-    def __init__ (self, rules):
+    def __init__ (self, rules, turn_log=None, registry=None, store=None, seed=None):
+        """
+        serve one set of rules, or with a fred_tenant.TenantRegistry,
+        route each session to the rules of its tenant; with a
+        fred_store.SessionStore, a session opened with a key carries on
+        from wherever the last one with that key left off; with a seed,
+        every run replies the same way to the same conversations
+        """
+
         self.rules = rules
+        self.turn_log = turn_log
+        self.registry = registry
+        self.store = store
+        self.seed = seed
+        self.session_numbers = itertools.count(1)
+
+
+    def swap_rules (self, rules):
+        """
+        replace the rules, e.g. after a reload; sessions move across to
+        the new rules on their next turn
+        """
+
+        self.rules = rules
+
+
+    def get_rng (self, key=None):
+        """
+        a generator for a new session; with a seed, each one gets derived
+        from the seed and the session key, as in fred_batch, or else from
+        the count of sessions so far
+        """
+
+        if self.seed is None:
+            return random.Random()
+
+        return random.Random("%s/%s" % (self.seed, key or "#%d" % next(self.session_numbers)))
+
+
+    def new_session (self, tenant=None, key=None):
+        rng = self.get_rng(key)
+        session = None
+
+        if self.store and key:
+            rules = self.registry.get_rules(tenant) if self.registry else self.rules
+            session = self.store.load(key, rules, tenant)
+
+            if session is not None:
+                session.rng = rng
+
+        if session is None:
+            if self.registry:
+                session = self.registry.new_session(tenant, rng)
+            else:
+                session = self.rules.new_session(rng)
+
+        session.key = key
+        return session
+
 
+    def get_rules (self, session):
+        if session.tenant is not None:
+            return self.registry.get_rules(session.tenant)
 
-    def chat (self, convo):
-        response = self.rules.choose_first()
+        return self.rules
+
+
+    def chat (self, convo, tenant=None):
+        if self.registry and tenant is None:
+            try:
+                tenant = convo.converse("tenant> ")
+            except EOFError:
+                return
+
+            if tenant not in self.registry.tenants:
+                convo.say("unknown tenant: %s" % tenant)
+                return
+
+        key = None
+
+        if self.store:
+            try:
+                key = convo.converse("session> ")
+            except EOFError:
+                return
+
+        try:
+            session = self.new_session(tenant, key)
+        except (fred_rules.RuleFileError, OSError):
+            convo.say("tenant unavailable: %s" % tenant)
+            return
+
+        response = session.rules.choose_first(session)
 
         while True:
             try:
@@ -56,11 +154,40 @@ class FRED (object):
                     break
             except EOFError:
                 break
-            else:
-                print(utterance)
 
-                response, selected_rule, weight = self.rules.choose_rule(utterance)
-                print(" (", selected_rule.name, weight, ")")
+            try:
+                # without a turn log, show which rule fired instead
+                response = self.respond(session, utterance, echo=not self.turn_log)
+            except (fred_rules.RuleFileError, OSError):
+                convo.say("tenant unavailable: %s" % tenant)
+                break
+
+
+    def respond (self, session, utterance, echo=False):
+        """
+        reply to one utterance within a session; with echo, print the
+        utterance and the rule which fired
+        """
+
+        start = time.perf_counter()
+        rules = self.get_rules(session)
+        session.attach(rules)
+
+        if echo:
+            print(utterance)
+
+        response, selected_rule, weight = rules.choose_rule(session, utterance)
+
+        if echo:
+            print(" (", selected_rule.name, weight, ")")
+
+        if self.store and session.key:
+            self.store.save(session.key, session)
+
+        if self.turn_log:
+            self.turn_log.log(session, utterance, selected_rule, weight, time.perf_counter() - start)
+
+        return response
 
 
     def chat_tcp (self, port):
@@ -71,8 +198,9 @@ class FRED (object):
         backlog = 5
 
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((host, port))
-        s.listen(BACKLOG)
+        s.listen(backlog)
 
         while True:
             client, address = s.accept() 
@@ -17,8 +17,8 @@
 ## limitations under the License.
 
 
+import array
 import math
-import operator
 import random
 
 
@@ -28,63 +28,85 @@ import random
 ######################################################################
 
 class FuzzyUnion (object):
+    # exponent scale for the normalised weights, and for the priority
+    weight_scale = 2.0
+    priority_scale = 0.1
+
     def __init__ (self):
-        self.rule_set = {}
+        self.index = {}
+        self.rules = []
+        self.weights = array.array("d")
+
+
+    def clear (self):
+        self.index.clear()
+        del self.rules[:]
+        del self.weights[:]
 
 
     def add_rule (self, rule, weight):
-        if rule.name not in self.rule_set:
+        i = self.index.get(rule.id)
+
+        if i is None:
             # add a new rule
-            self.rule_set[rule.name] = [rule, weight]
+            self.index[rule.id] = len(self.rules)
+            self.rules.append(rule)
+            self.weights.append(weight)
         else:
             # update the weight for an existing rule
-            r, prev_weight = self.rule_set[rule.name]
-            self.rule_set[rule.name] = [rule, prev_weight + weight]
+            self.weights[i] += weight
+
 
+    def select_rule (self, rng=random, session=None):
+        """
+        draw one rule, with probability proportional to
 
-    @staticmethod
-    def fuzzy_sort (x):
-        [name, [rule, weight]] = x
-        return weight, rule.priority
+            exp(weight_scale * weight / total + priority_scale * priority)
 
+        i.e. something vaguely akin to an exponential distribution over
+        the candidates ranked by weight and priority; this runs as an
+        exponential race (equivalent to Gumbel-max), so it takes one pass
+        over the candidates and no sorting; given a session, the rules
+        it has fired recently get discounted
+        """
 
-    def select_rule (self):
-        # sort descending based on weight, priority
+        if len(self.rules) == 1:
+            return self.rules[0], self.weights[0]
 
-        sorted_rules = sorted(self.rule_set.items(),
-                              key=lambda x: FuzzyUnion.fuzzy_sort(x),
-                              reverse=True
-                              )
+        scale = FuzzyUnion.weight_scale / sum(self.weights)
+        priority_scale = FuzzyUnion.priority_scale
+        expovariate = rng.expovariate
+        exp = math.exp
 
-        weight_dist = map(lambda x: x[1][1], sorted_rules)
-        tot_sum = sum(weight_dist)
+        # each candidate draws an arrival time with a rate of its own
+        # unnormalised probability, and the earliest arrival wins
 
-        # convert the sorted list of weights into something vaguely
-        # akin to an exponential distribution (if you squint hard)
+        best_time = float("inf")
+        best = 0
 
-        exp_dist = [math.exp(x / tot_sum * -2.0) for x in weight_dist]
-        estimator = random.uniform(0.0, sum(exp_dist))
-        i = 0
+        if session is not None:
+            recent = session.recent
+            turns = session.turns
+            discounts = session.discounts
 
-        # generate a random variable and use that to select a rule
+        for i, (rule, weight) in enumerate(zip(self.rules, self.weights)):
+            t = expovariate(1.0) * exp(-(weight * scale + rule.priority * priority_scale))
 
-        for x in exp_dist:
-            if estimator <= x:
-                break
-            else:
-                i += 1
-                estimator -= x
+            if session is not None and rule.name in recent:
+                # a discounted rule arrives at a proportionately lower rate
+                t /= discounts[turns - recent[rule.name]]
 
-        rule_name, rule_value = sorted_rules[i]
-        rule, weight = self.rule_set[rule_name]
+            if t < best_time:
+                best_time = t
+                best = i
 
-        return rule, weight
+        return self.rules[best], self.weights[best]
 
 
     def is_empty (self):
-        return len(self.rule_set) == 0
+        return len(self.rules) == 0
 
 
 if __name__=='__main__':
-    fuzzy = Fuzzy()
-    print(fuzzy)
+    fuzzy = FuzzyUnion()
+    print(fuzzy.is_empty())
@@ -30,7 +30,32 @@ import re
 ######################################################################
 
 class Language (object):
-    word_pat = re.compile("([\w\d]+)")
+    # a word, with an optional contraction suffix
+    token_pat = re.compile("(\\w+)(?:'(\\w+))?")
+
+    contractions = { "m": "am",
+                     "d": "would",
+                     "s": "is",
+                     "ll": "will",
+                     "re": "are",
+                     "ve": "have"
+                     }
+
+    negations = { "can": "can",
+                  "don": "do",
+                  "didn": "did",
+                  "isn": "is",
+                  "aren": "are",
+                  "won": "will",
+                  "shan": "shall",
+                  "couldn": "could",
+                  "wouldn": "would",
+                  "shouldn": "should",
+                  "haven": "have",
+                  "doesn": "does"
+                  }
+
+    unknown = -1
 
     tense = { "you": "we robots",
               "i": "you",
@@ -47,32 +72,71 @@ class Language (object):
               }
 
     def __init__ (self):
-        pass
+        self.vocab = {}
 
     def parse (self, utterance):
-        v = []
+        """
+        split an utterance into lower case word tokens, in one scan,
+        expanding contractions and negations ("i'm" => "i am", "don't"
+        => "do not") while dropping other punctuation
+        """
 
-        for token in utterance.split(" "):
-            m = Language.word_pat.match(token)
+        v = []
 
-            if m:
-                v.append(m.group(1).lower().strip())
+        for word, suffix in Language.token_pat.findall(utterance.lower()):
+            if not suffix:
+                v.append(word)
+            elif suffix == "t" and word in Language.negations:
+                v.append(Language.negations[word])
+                v.append("not")
+            elif suffix in Language.contractions:
+                v.append(word)
+                v.append(Language.contractions[suffix])
+            else:
+                v.append(word + "'" + suffix)
 
         return tuple(v)
 
 
-    def invert (self, fragment):
-        inversion = []
+    def intern (self, tokens):
+        """
+        map tokens to integer IDs, adding any new ones to the vocabulary;
+        used while building the rule indexes
+        """
 
-        for word in fragment:
-            if word in Language.tense:
-                inversion.append(Language.tense[word])
-            else:
-                inversion.append(word)
+        vocab = self.vocab
+        return tuple(vocab.setdefault(token, len(vocab)) for token in tokens)
+
+
+    def encode (self, tokens):
+        """
+        map tokens to integer IDs, where words which appear nowhere in
+        the rules all become Language.unknown
+        """
+
+        get = self.vocab.get
+        unknown = Language.unknown
+        return tuple(get(token, unknown) for token in tokens)
 
-        return inversion
+
+    def get_positions (self, stimulus):
+        """
+        map each token in a stimulus to the position where it first occurs
+        """
+
+        positions = {}
+
+        for i, token in enumerate(stimulus):
+            positions.setdefault(token, i)
+
+        return positions
+
+
+    def invert (self, fragment):
+        translate = Language.tense.get
+        return [translate(word, word) for word in fragment]
 
 
 if __name__=='__main__':
     lang = Language()
-    print(lang.parse("Hi there Fred."))
+    print(lang.parse("Hi there Fred. I'm sure you don't know me."))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import fred_cache
+import fred_lang
+import fred_rules
+
+import argparse
+import sys
+
+
+######################################################################
+## rulebase linker
+## check a rule file ahead of time: every reference gets resolved (any
+## dangling one fails the link, see Rule.link_rules), then the rules
+## which nothing can reach get reported, and the linked and indexed
+## rules get written out as the compiled cache
+######################################################################
+
+def get_reachable (rule_dict, first_action, fuzzy_dict):
+    """
+    the action rules which can fire other than as a fallback: the first
+    action, those invoked by regex and fuzzy rules, and then whatever
+    those expect or lead on to next
+    """
+
+    queue = [first_action]
+
+    for r in rule_dict.values():
+        if isinstance(r, fred_rules.RegexRule):
+            queue.extend(r.invoked)
+
+    for r in fuzzy_dict.values():
+        queue.extend(r.member_rules)
+
+    reachable = set()
+
+    while queue:
+        r = queue.pop()
+
+        if r.id not in reachable:
+            reachable.add(r.id)
+            queue.extend(action for response, action in r.expect_rules)
+            queue.extend(r.next_rules)
+
+    return reachable
+
+
+def get_warnings (rule_dict, first_action, fuzzy_dict):
+    """
+    the (rule name, message) pairs for rules which link, but which can
+    never fire or get used as intended
+    """
+
+    warnings = []
+    reachable = get_reachable(rule_dict, first_action, fuzzy_dict)
+    expected = set()
+    captured = set()
+
+    for r in rule_dict.values():
+        if isinstance(r, fred_rules.ActionRule):
+            expected.update(response.id for response, action in r.expect_rules)
+        elif isinstance(r, fred_rules.RegexRule):
+            for phrase in r.vector:
+                captured.update(m.group(1).lower() for m in fred_rules.Rules.property_pat.finditer(phrase))
+
+    for r in rule_dict.values():
+        if isinstance(r, fred_rules.ActionRule):
+            if r.id not in reachable:
+                warnings.append((r.name, "action rule is never invoked, so only fires as a fallback"))
+
+            if r.requires and r.requires not in captured:
+                warnings.append((r.name, "requires $%s, which no regex phrase captures" % r.requires))
+
+        elif isinstance(r, fred_rules.ResponseRule) and r.id not in expected:
+            warnings.append((r.name, "response rule is never expected"))
+
+    return warnings
+
+
+def main ():
+    parser = argparse.ArgumentParser(description="link and check a JFRED rule file")
+    parser.add_argument("rule_file", help="JFRED rule file")
+    parser.add_argument("--output", help="write the linked rules here, instead of the rule file's cache")
+    parser.add_argument("--check", action="store_true", help="only report problems, without writing the linked rules")
+    parser.add_argument("--processes", type=int, default=0, help="parse the rule file in this many worker processes")
+    args = parser.parse_args()
+
+    try:
+        rule_dict, first_action, fuzzy_dict = fred_rules.Rule.read_file(args.rule_file, args.processes)
+    except fred_rules.RuleFileError as e:
+        print(e, file=sys.stderr)
+        print("%s: %d errors" % (args.rule_file, len(e.errors)), file=sys.stderr)
+        sys.exit(1)
+
+    warnings = get_warnings(rule_dict, first_action, fuzzy_dict)
+
+    for name, message in warnings:
+        print("%s: %s: %s" % (args.rule_file, name, message))
+
+    print("%s: linked %d rules and %d fuzzy rules, %d warnings" % (args.rule_file, len(rule_dict), len(fuzzy_dict), len(warnings)))
+
+    if not args.check:
+        rules = fred_rules.Rules(fred_lang.Language(), rule_dict, first_action, fuzzy_dict)
+        fred_cache.RuleCache(args.rule_file, args.output).save(rules)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import fred_rules
+
+import argparse
+import array
+import asyncio
+import collections
+import gzip
+import json
+import multiprocessing
+import random
+import sys
+import time
+
+
+######################################################################
+## load generator
+## many simulated clients talking to a pyfred TCP server at once, each
+## replaying a conversation from a corpus or a turn log, or sampling
+## utterances from the rulebase's own regex phrases; reports the time
+## to connect, the reply latencies and the errors
+######################################################################
+
+def read_corpus (filename):
+    """
+    read the conversations to replay: a turn log (see fred_log) gets
+    grouped by session, while a text file has one utterance per line,
+    with blank lines between conversations
+    """
+
+    if filename.endswith(".jsonl") or filename.endswith(".jsonl.gz"):
+        opener = gzip.open if filename.endswith(".gz") else open
+        sessions = collections.OrderedDict()
+
+        with opener(filename, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    turn = json.loads(line)
+                    sessions.setdefault(turn["session"], []).append(turn["utterance"])
+
+        return list(sessions.values())
+
+    convos = [[]]
+
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+
+            if line:
+                convos[-1].append(line)
+            elif convos[-1]:
+                convos.append([])
+
+    return [convo for convo in convos if convo]
+
+
+def read_phrases (filename, fill="fred"):
+    """
+    the phrases of every regex rule in a rule file, which make for
+    utterances that match; property captures get filled with a word
+    """
+
+    rule_dict, first_action, fuzzy_dict = fred_rules.Rule.read_file(filename)
+    phrases = []
+
+    for r in rule_dict.values():
+        if isinstance(r, fred_rules.RegexRule):
+            phrases.extend(fred_rules.Rules.property_pat.sub(fill, phrase) for phrase in r.vector)
+
+    return phrases
+
+
+class LoadStats (object):
+    percentiles = (50, 90, 99, 99.9)
+
+    def __init__ (self):
+        self.connect = array.array("d")
+        self.latency = array.array("d")
+        self.conversations = 0
+        self.errors = collections.Counter()
+
+
+    def merge (self, other):
+        self.connect.extend(other.connect)
+        self.latency.extend(other.latency)
+        self.conversations += other.conversations
+        self.errors.update(other.errors)
+
+
+    @staticmethod
+    def get_percentiles (values):
+        if not values:
+            return []
+
+        values = sorted(values)
+        return [(p, values[min(len(values) - 1, int(len(values) * p / 100.0))]) for p in LoadStats.percentiles] + [("max", values[-1])]
+
+
+    def report (self, elapsed, out=sys.stdout):
+        errors = sum(self.errors.values())
+
+        print("%d conversations, %d turns in %.2fs: %.1f turns/s" % (self.conversations, len(self.latency), elapsed, len(self.latency) / max(elapsed, 1e-9)), file=out)
+        print("errors: %d (%.2f%% of conversations)" % (errors, 100.0 * errors / max(self.conversations, 1)), file=out)
+
+        for kind, n in self.errors.most_common():
+            print("  %s: %d" % (kind, n), file=out)
+
+        for label, values in (("connect", self.connect), ("reply", self.latency)):
+            line = "  ".join("p%s %.3fms" % (p, 1000.0 * v) if p != "max" else "max %.3fms" % (1000.0 * v) for p, v in LoadStats.get_percentiles(values))
+            print("%-8s %s" % (label, line or "-"), file=out)
+
+
+class LoadClient (object):
+    timeout = 30.0
+
+    def __init__ (self, host, port, tenant=None, session_prefix=None):
+        self.host = host
+        self.port = port
+        self.tenant = tenant
+        self.session_prefix = session_prefix
+
+
+    async def read_prompt (self, reader):
+        data = await asyncio.wait_for(reader.readuntil(b"> "), self.timeout)
+        return data.decode("utf-8", "replace")
+
+
+    async def converse (self, number, utterances, stats):
+        """
+        hold one conversation: the setup time runs from connecting to
+        the server's first reply, answering its tenant and session
+        prompts on the way
+        """
+
+        start = time.perf_counter()
+        writer = None
+
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+            prompt = await self.read_prompt(reader)
+
+            if prompt == "tenant> ":
+                writer.write(("%s\n" % (self.tenant or "")).encode("utf-8"))
+                prompt = await self.read_prompt(reader)
+
+            if prompt == "session> ":
+                key = "%s%d" % (self.session_prefix, number) if self.session_prefix is not None else ""
+                writer.write(("%s\n" % key).encode("utf-8"))
+                prompt = await self.read_prompt(reader)
+
+            if not prompt.endswith("\n> "):
+                raise ConnectionError("unexpected prompt: %r" % prompt)
+
+            stats.connect.append(time.perf_counter() - start)
+
+            for utterance in utterances:
+                start = time.perf_counter()
+                writer.write((utterance + "\n").encode("utf-8"))
+                await self.read_prompt(reader)
+                stats.latency.append(time.perf_counter() - start)
+
+        except asyncio.TimeoutError:
+            stats.errors["timeout"] += 1
+        except asyncio.IncompleteReadError:
+            stats.errors["disconnected"] += 1
+        except asyncio.LimitOverrunError:
+            # a reply without its prompt within the stream's buffer limit
+            stats.errors["overlong reply"] += 1
+        except (OSError, ValueError) as e:
+            stats.errors[type(e).__name__] += 1
+        finally:
+            stats.conversations += 1
+
+            if writer:
+                writer.close()
+
+
+    async def run (self, convos, clients, first=0):
+        """
+        hold the conversations, at most clients of them at once
+        """
+
+        stats = LoadStats()
+        limit = asyncio.Semaphore(clients)
+
+        async def bounded (number, utterances):
+            async with limit:
+                await self.converse(number, utterances, stats)
+
+        await asyncio.gather(*[bounded(first + i, utterances) for i, utterances in enumerate(convos)])
+        return stats
+
+
+def get_convos (args, count, rng):
+    """
+    the utterances for each of count conversations, cycling through the
+    corpus, or sampled from the rulebase
+    """
+
+    if args.corpus:
+        corpus = read_corpus(args.corpus)
+
+        if not corpus:
+            raise ValueError("no utterances in " + args.corpus)
+
+        return [corpus[i % len(corpus)][:args.turns] for i in range(count)]
+
+    phrases = read_phrases(args.rule_file)
+    return [[rng.choice(phrases) for j in range(args.turns)] for i in range(count)]
+
+
+def run_process (args, convos, first):
+    client = LoadClient(args.host, args.port, args.tenant, args.session_prefix)
+    return asyncio.run(client.run(convos, args.clients, first))
+
+
+def main ():
+    parser = argparse.ArgumentParser(description="drive a pyfred TCP server with many simulated conversations")
+    parser.add_argument("port", type=int, help="the server's TCP port")
+    parser.add_argument("--host", default="127.0.0.1", help="the server's host")
+    parser.add_argument("--rules", dest="rule_file", help="sample utterances from the regex phrases of this rule file")
+    parser.add_argument("--corpus", help="replay the conversations in this file: one utterance per line with blank lines between conversations, or a JSONL turn log")
+    parser.add_argument("--conversations", type=int, default=1000, help="how many conversations to hold in all")
+    parser.add_argument("--clients", type=int, default=100, help="how many conversations each process holds at once")
+    parser.add_argument("--turns", type=int, default=10, help="the most utterances per conversation")
+    parser.add_argument("--processes", type=int, default=1, help="split the conversations across this many processes")
+    parser.add_argument("--tenant", help="the tenant to give, for a server with --tenants")
+    parser.add_argument("--session-prefix", help="give each conversation a session key with this prefix, for a server with --sessions")
+    parser.add_argument("--seed", type=int, help="seed for sampling the utterances")
+    args = parser.parse_args()
+
+    if bool(args.rule_file) == bool(args.corpus):
+        parser.error("give either --rules or --corpus")
+
+    if args.conversations < 1 or args.clients < 1:
+        parser.error("--conversations and --clients must be at least 1")
+
+    try:
+        convos = get_convos(args, args.conversations, random.Random(args.seed))
+    except (fred_rules.RuleFileError, OSError, ValueError) as e:
+        print("ERROR:", e, file=sys.stderr)
+        sys.exit(1)
+
+    processes = max(1, min(args.processes, len(convos)))
+    share = (len(convos) + processes - 1) // processes
+    jobs = [(args, convos[i:i + share], i) for i in range(0, len(convos), share)]
+
+    start = time.perf_counter()
+
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.starmap(run_process, jobs)
+    else:
+        results = [run_process(*job) for job in jobs]
+
+    elapsed = time.perf_counter() - start
+
+    stats = LoadStats()
+
+    for result in results:
+        stats.merge(result)
+
+    stats.report(elapsed)
+
+
+if __name__=='__main__':
+    main()
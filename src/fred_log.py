@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import gzip
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+
+######################################################################
+## conversation log
+## "Fred.logChat()" - each turn gets queued in memory, then a
+## background thread writes the turns out in batches as JSON lines,
+## so the reply path never waits on the disk
+######################################################################
+
+class TurnLog (threading.Thread):
+    queue_size = 10000
+    batch_size = 500
+    flush_interval = 1.0
+    max_bytes = 64 * 1024 * 1024
+    backups = 5
+
+    def __init__ (self, filename, block=False):
+        """
+        log to a JSONL file, gzip compressed if its name ends in ".gz";
+        when the queue is full a turn gets dropped, unless block is set,
+        in which case the caller waits for the writer to catch up; the
+        file gets opened here, so that a log which cannot be written
+        raises OSError before any turn gets queued for it
+        """
+
+        super(TurnLog, self).__init__(name="turn-log", daemon=True)
+        self.filename = filename
+        self.block = block
+        self.compress = filename.endswith(".gz")
+        self.queue = queue.Queue(self.queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.file = None
+        self.size = 0
+        self.open()
+
+
+    def clone (self, suffix):
+        """
+        a new, unstarted log with the same settings, writing to its own
+        file; forked workers each need one, since threads do not survive
+        a fork and the workers must not rotate each other's files
+        """
+
+        root, ext = self.split_name()
+        return TurnLog("%s.%s%s" % (root, suffix, ext), self.block)
+
+
+    def split_name (self):
+        if self.compress:
+            return self.filename[:-3], ".gz"
+
+        return self.filename, ""
+
+
+    def log (self, session, utterance, rule, weight, latency):
+        """
+        queue one turn; this only does a tuple and a queue put, leaving
+        the encoding to the writer thread
+        """
+
+        turn = (time.time(), session.id, utterance, rule.name, weight, latency)
+
+        if self.block:
+            self.queue.put(turn)
+        else:
+            try:
+                self.queue.put_nowait(turn)
+            except queue.Full:
+                self.dropped += 1
+
+
+    def open (self):
+        if self.compress:
+            self.file = gzip.open(self.filename, "ab")
+        else:
+            self.file = open(self.filename, "ab")
+
+        self.size = os.path.getsize(self.filename)
+
+
+    def rotate (self):
+        """
+        shift the older files along, e.g. turns.jsonl -> turns.jsonl.1,
+        discarding the oldest, and start a new file
+        """
+
+        self.file.close()
+        root, ext = self.split_name()
+
+        for i in range(self.backups - 1, 0, -1):
+            src = "%s.%d%s" % (root, i, ext)
+
+            if os.path.exists(src):
+                os.replace(src, "%s.%d%s" % (root, i + 1, ext))
+
+        if self.backups > 0:
+            os.replace(self.filename, "%s.1%s" % (root, ext))
+        else:
+            os.remove(self.filename)
+
+        self.open()
+
+
+    def write (self, batch):
+        lines = []
+
+        for when, session_id, utterance, rule_name, weight, latency in batch:
+            turn = { "time": round(when, 6),
+                     "session": session_id,
+                     "utterance": utterance,
+                     "rule": rule_name,
+                     "weight": weight,
+                     "latency": round(latency, 6)
+                     }
+
+            lines.append(json.dumps(turn, ensure_ascii=False))
+
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+
+        # NB: the size of a compressed file gets counted before compression
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+
+        self.file.write(data)
+        self.size += len(data)
+        self.written += len(batch)
+
+
+    def run (self):
+        """
+        write the queued turns, a batch at a time, until the log gets
+        closed and the queue has drained
+        """
+
+        closing = False
+
+        while not closing:
+            try:
+                turn = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self.file.flush()
+                continue
+
+            batch = []
+
+            while turn is not None:
+                batch.append(turn)
+
+                if len(batch) >= self.batch_size:
+                    break
+
+                try:
+                    turn = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                closing = True
+
+            try:
+                if batch:
+                    self.write(batch)
+            except OSError as e:
+                print("WARNING: cannot write turn log", self.filename, e, file=sys.stderr)
+
+        self.file.close()
+
+
+    def close (self):
+        """
+        write out everything still queued, then stop the writer
+        """
+
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        elif not self.file.closed:
+            # never started
+            self.file.close()
+
+        if self.dropped:
+            print("WARNING: turn log", self.filename, "dropped", self.dropped, "turns", file=sys.stderr)
+
+
+if __name__=='__main__':
+    import types
+
+    log = TurnLog(sys.argv[1])
+    log.start()
+    log.log(types.SimpleNamespace(id=1), "hello", types.SimpleNamespace(name="greeting"), 2.0, 0.0001)
+    log.close()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import array
+import collections
+import threading
+
+
+######################################################################
+## phrase matching
+## an Aho-Corasick automaton over token tuples, so that every regex
+## phrase found within a stimulus comes out of one pass
+######################################################################
+
+class PhraseMatcher (object):
+    def __init__ (self):
+        # node 0 is the root of the token trie; while phrases are being
+        # added each node keeps a dict of its children, which compile()
+        # then flattens into one transition dict keyed by node and token
+        self.children = [{}]
+        self.goto = {}
+        self.fail = array.array("l", [0])
+        self.out = {}
+        self.values = []
+        self.phrase_ids = {}
+        self.compiled = False
+
+
+    @staticmethod
+    def edge (node, token):
+        return (node << 32) | token
+
+
+    def add (self, phrase, value):
+        """
+        add a phrase (a tuple of non-negative token IDs) with its payload;
+        adding the same phrase again replaces the payload, like a dict
+        would; all phrases must be added before compiling
+        """
+
+        if self.compiled:
+            raise ValueError("phrase matcher is already compiled")
+
+        if phrase in self.phrase_ids:
+            self.values[self.phrase_ids[phrase]] = value
+            return
+
+        node = 0
+
+        for token in phrase:
+            child = self.children[node].get(token)
+
+            if child is None:
+                child = len(self.children)
+                self.children[node][token] = child
+                self.children.append({})
+
+            node = child
+
+        phrase_id = len(self.values)
+        self.phrase_ids[phrase] = phrase_id
+        self.values.append(value)
+        self.out[node] = self.out.get(node, ()) + (phrase_id,)
+
+
+    def compile (self):
+        """
+        build the failure links breadth-first, merging the outputs of
+        each node's suffixes into it, then flatten the trie
+        """
+
+        children = self.children
+        fail = array.array("l", [0]) * len(children)
+        out = self.out
+        queue = list(children[0].values())
+        i = 0
+
+        while i < len(queue):
+            node = queue[i]
+            i += 1
+
+            for token, child in children[node].items():
+                queue.append(child)
+                state = fail[node]
+
+                while state and token not in children[state]:
+                    state = fail[state]
+
+                fail[child] = children[state].get(token, 0)
+
+                if fail[child] and fail[child] in out:
+                    out[child] = out.get(child, ()) + out[fail[child]]
+
+        edge = PhraseMatcher.edge
+
+        for node, transitions in enumerate(children):
+            for token, child in transitions.items():
+                self.goto[edge(node, token)] = child
+
+        self.fail = fail
+        self.children = None
+        self.phrase_ids = None
+        self.compiled = True
+        return self
+
+
+    def match (self, tokens):
+        """
+        return the payloads of all the distinct phrases which occur as
+        contiguous sublists of the given token IDs, in order of discovery;
+        negative IDs (unknown words) match nothing
+        """
+
+        if not self.compiled:
+            self.compile()
+
+        if not tokens:
+            return []
+
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        seen = set()
+        found = []
+
+        # an empty phrase occurs within any non-empty stimulus
+
+        for phrase_id in out.get(0, ()):
+            seen.add(phrase_id)
+            found.append(self.values[phrase_id])
+
+        node = 0
+
+        for token in tokens:
+            if token < 0:
+                node = 0
+                continue
+
+            while node and (node << 32) | token not in goto:
+                node = fail[node]
+
+            node = goto.get((node << 32) | token, 0)
+
+            if node in out:
+                for phrase_id in out[node]:
+                    if phrase_id not in seen:
+                        seen.add(phrase_id)
+                        found.append(self.values[phrase_id])
+
+        return found
+
+
+    def __len__ (self):
+        return len(self.values)
+
+
+class MatchCache (object):
+    """
+    an LRU cache of the weighted candidates matched for each stimulus;
+    it holds candidates rather than replies, so that the random choice
+    and each session's repeat rules still apply on a hit
+    """
+
+    def __init__ (self, size=10000, max_tokens=8):
+        # only short stimuli get cached: those are the ones which keep
+        # coming back, and this also bounds the size of each entry
+        self.size = size
+        self.max_tokens = max_tokens
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __getstate__ (self):
+        # an empty cache gets pickled along with the rules
+        return (self.size, self.max_tokens)
+
+
+    def __setstate__ (self, state):
+        self.__init__(*state)
+
+
+    def get (self, key):
+        with self.lock:
+            candidates = self.entries.get(key)
+
+            if candidates is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+
+            return candidates
+
+
+    def put (self, key, candidates):
+        with self.lock:
+            self.entries[key] = candidates
+
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def get_hit_rate (self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+
+    def __len__ (self):
+        return len(self.entries)
+
+
+if __name__=='__main__':
+    matcher = PhraseMatcher()
+    matcher.add((1, 2), "BATCAVE")
+    matcher.add((2,), "CAVE")
+    matcher.add((3, 4), "RIDDLER")
+    print(matcher.match((5, 3, 1, 2, -1, 6)))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import array
+import bisect
+import http.server
+import sys
+import threading
+import time
+
+
+######################################################################
+## reply metrics
+## per-stage timings of the reply engine, rule fire counts and the
+## sizes of the candidate sets, served as text over HTTP; while the
+## module-level "active" stays None, the reply path skips all of it
+######################################################################
+
+active = None
+
+
+def enable (sample_every=1):
+    """
+    start collecting metrics, timing one turn in every sample_every
+    """
+
+    global active
+    active = Metrics(sample_every)
+    return active
+
+
+class Histogram (object):
+    def __init__ (self, bounds):
+        self.bounds = bounds
+        self.counts = array.array("L", [0]) * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe (self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def render (self, name, labels=""):
+        """
+        the Prometheus text format for a histogram, with cumulative
+        bucket counts
+        """
+
+        sep = "," if labels else ""
+        lines = []
+        total = 0
+
+        for bound, n in zip(self.bounds, self.counts):
+            total += n
+            lines.append('%s_bucket{%s%sle="%g"} %d' % (name, labels, sep, bound, total))
+
+        lines.append('%s_bucket{%s%sle="+Inf"} %d' % (name, labels, sep, self.count))
+        labels = "{%s}" % labels if labels else ""
+        lines.append("%s_sum%s %.9f" % (name, labels, self.sum))
+        lines.append("%s_count%s %d" % (name, labels, self.count))
+        return lines
+
+
+class Stopwatch (object):
+    __slots__ = ("metrics", "last")
+
+    def __init__ (self, metrics):
+        self.metrics = metrics
+        self.last = time.perf_counter()
+
+
+    def lap (self, stage):
+        """
+        charge the time since the previous lap to a stage
+        """
+
+        now = time.perf_counter()
+        self.metrics.timings[stage].observe(now - self.last)
+        self.last = now
+
+
+class Metrics (object):
+    stages = ("tokenise", "regex", "fuzzy", "fallback", "select", "render", "reply")
+    time_bounds = tuple(1e-6 * 2 ** i for i in range(21))
+    size_bounds = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+    def __init__ (self, sample_every=1):
+        self.sample_every = max(1, sample_every)
+        self.turns = 0
+        self.timings = dict((stage, Histogram(Metrics.time_bounds)) for stage in Metrics.stages)
+        self.candidates = Histogram(Metrics.size_bounds)
+        self.fires = {}
+        self.match_cache = None
+
+
+    def sample (self):
+        """
+        count a turn, and say whether it should be timed
+        """
+
+        self.turns += 1
+        return self.turns % self.sample_every == 0
+
+
+    def count_fire (self, rule):
+        self.fires[rule.name] = self.fires.get(rule.name, 0) + 1
+
+
+    def render (self):
+        lines = ["# TYPE fred_turns_total counter",
+                 "fred_turns_total %d" % self.turns,
+                 "# TYPE fred_stage_seconds histogram"
+                 ]
+
+        for stage in Metrics.stages:
+            lines.extend(self.timings[stage].render("fred_stage_seconds", 'stage="%s"' % stage))
+
+        lines.append("# TYPE fred_candidates histogram")
+        lines.extend(self.candidates.render("fred_candidates"))
+        cache = self.match_cache
+
+        if cache is not None:
+            lines.extend(["# TYPE fred_match_cache_hits_total counter",
+                          "fred_match_cache_hits_total %d" % cache.hits,
+                          "# TYPE fred_match_cache_misses_total counter",
+                          "fred_match_cache_misses_total %d" % cache.misses,
+                          "# TYPE fred_match_cache_evictions_total counter",
+                          "fred_match_cache_evictions_total %d" % cache.evictions,
+                          "# TYPE fred_match_cache_entries gauge",
+                          "fred_match_cache_entries %d" % len(cache)
+                          ])
+
+        lines.append("# TYPE fred_rule_fires_total counter")
+
+        for name, n in sorted(list(self.fires.items())):
+            lines.append('fred_rule_fires_total{rule="%s"} %d' % (name, n))
+
+        return "\n".join(lines) + "\n"
+
+
+######################################################################
+## metrics endpoint
+######################################################################
+
+class MetricsHandler (http.server.BaseHTTPRequestHandler):
+    def do_GET (self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = (active.render() if active else "").encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message (self, format, *args):
+        pass
+
+
+def serve_metrics (port, host="127.0.0.1"):
+    """
+    serve the active metrics from a background thread
+    """
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+if __name__=='__main__':
+    metrics = enable()
+    metrics.timings["render"].observe(0.00003)
+    sys.stdout.write(metrics.render())
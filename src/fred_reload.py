@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import fred_cache
+
+import os
+import sys
+import threading
+
+
+######################################################################
+## hot reload
+## watch a rule file, rebuild its rules in the background, then swap
+## them in as one reference assignment so readers never wait
+######################################################################
+
+class RuleWatcher (threading.Thread):
+    interval = 2.0
+
+    def __init__ (self, fred, lang, filename, use_cache=True):
+        super(RuleWatcher, self).__init__(name="rule-watcher", daemon=True)
+        self.fred = fred
+        self.lang = lang
+        self.filename = filename
+        self.use_cache = use_cache
+        self.stamp = self.get_stamp()
+        self.stopping = threading.Event()
+
+
+    def get_stamp (self):
+        try:
+            stat = os.stat(self.filename)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+
+    def reload (self):
+        """
+        parse and index the rule file, then swap in the new rules; if the
+        file does not parse, keep serving the current rules
+        """
+
+        try:
+            rules = fred_cache.load_rules(self.lang, self.filename, use_cache=self.use_cache)
+        except (Exception, SystemExit) as e:
+            print("WARNING: cannot reload", self.filename, e, file=sys.stderr)
+            return False
+
+        self.fred.swap_rules(rules)
+        return True
+
+
+    def run (self):
+        while not self.stopping.wait(self.interval):
+            stamp = self.get_stamp()
+
+            if stamp and stamp != self.stamp:
+                self.stamp = stamp
+                self.reload()
+
+
+    def stop (self):
+        self.stopping.set()
+
+
+if __name__=='__main__':
+    print(RuleWatcher(None, None, sys.argv[1]).get_stamp())
@@ -18,8 +18,18 @@
 
 
 import fred_fuzzy
-
-import random
+import fred_match
+import fred_metrics
+import fred_session
+import fred_table
+
+import array
+import bisect
+import collections
+import itertools
+import math
+import multiprocessing
+import os
 import re
 import sys
 
@@ -36,48 +46,206 @@ class ParseError (Exception):
         return repr(self.value)
 
 
+class RuleFileError (ParseError):
+    """
+    every error found while reading a rule file, as a list of
+    (line number, message) pairs
+    """
+
+    def __init__ (self, filename, errors):
+        super(RuleFileError, self).__init__(errors)
+        self.filename = filename
+        self.errors = errors
+
+    def __str__ (self):
+        return "\n".join("%s:%d: %s" % (self.filename, line_number, message) for line_number, message in self.errors)
+
+
 class Rules (object):
-    def __init__ (self, lang, rule_dict, first_action, fuzzy_dict):
+    match_cache_size = 10000
+    fallback_tries = 32
+    property_pat = re.compile("\\$(\\w+)")
+
+    def __init__ (self, lang, rule_dict, first_action, fuzzy_dict, strings=None):
         self.lang = lang
         self.rule_dict = rule_dict
         self.first_action = first_action
 
-        # 1. create an inverted index for the fuzzy sets
+        # each set of rules gets its own cache, so reloading the rules
+        # also invalidates everything matched against the old ones
+        self.match_cache = fred_match.MatchCache(Rules.match_cache_size)
+        self.property_cache = fred_match.MatchCache(Rules.match_cache_size)
+
+        # 1. create an inverted index for the fuzzy sets, keyed by the
+        # ID of the stimulus token which triggers each one
 
         self.fuzzy_sets = {}
 
         for name, r in fuzzy_dict.items():
-            self.fuzzy_sets[name] = list(map(lambda x: (self.rule_dict[r.members[x]], r.weights[x]), range(0, len(r.members))))
+            token_id, = self.lang.intern((name,))
+            self.fuzzy_sets[token_id] = (r.member_rules, r.weights)
 
         # 2. randomly shuffle the order of responses within all the
         # action rules, and establish priority rankings (later)
 
         self.action_rules = [r for r in self.rule_dict.values() if isinstance(r, ActionRule)]
 
+        # every action rule starts out as a fallback candidate; each
+        # session then skips the ones it has used (see Session.is_fallback)
+
+        self.fallback_rules = tuple(self.action_rules)
+
+        # the candidates all weigh 1.0, so their odds depend only on
+        # their priority and their recency: group them by priority, each
+        # group weighed by its size and rank (see Rules.choose_fallback)
+
+        groups = {}
+
+        for r in self.fallback_rules:
+            groups.setdefault(r.priority, []).append(r)
+
+        self.fallback_groups = [tuple(groups[priority]) for priority in sorted(groups)]
+        self.fallback_weights = list(itertools.accumulate(len(group) * math.exp(fred_fuzzy.FuzzyUnion.priority_scale * group[0].priority) for group in self.fallback_groups))
+
         # 3. randomly shuffle the intro rule(s)
 
         self.intro_rules = [r for r in self.rule_dict.values() if isinstance(r, IntroRule)]
 
-        # 4. create an inverted index for the regex phrases
+        # 4. create an inverted index for the regex phrases, then
+        # compile it into a multi-pattern matcher over token IDs; a
+        # phrase with a $property in it matches on the words around
+        # the property, which then captures whatever the user said there
 
-        self.regex_phrases = {}
+        regex_phrases = {}
+        property_phrases = {}
 
         for r in self.rule_dict.values():
             if isinstance(r, RegexRule):
-                try:
-                    invoked = set(map(lambda x: self.rule_dict[x], r.invokes.split(" ")))
-
-                    for phrase in r.vector:
+                for phrase in r.vector:
+                    m = Rules.property_pat.search(phrase)
+
+                    if m:
+                        prefix = self.lang.parse(phrase[:m.start()])
+                        suffix = self.lang.parse(phrase[m.end():])
+                        phrase_tuple = tuple(prefix or suffix)
+                        capture = (m.group(1).lower(), prefix, suffix)
+                        property_phrases[phrase_tuple] = property_phrases.get(phrase_tuple, ()) + (capture,)
+                    else:
                         phrase_tuple = tuple(self.lang.parse(phrase))
-                        self.regex_phrases[phrase_tuple] = invoked
 
-                except KeyError as e:
-                    print("ERROR: references unknown action rule", e)
-                    sys.exit(1)
+                    regex_phrases[phrase_tuple] = r.invoked
+
+        self.phrase_matcher = fred_match.PhraseMatcher()
+
+        for phrase_tuple, invoked in regex_phrases.items():
+            self.phrase_matcher.add(self.lang.intern(phrase_tuple), invoked)
+
+        self.phrase_matcher.compile()
+        self.property_matcher = fred_match.PhraseMatcher()
+
+        for phrase_tuple, captures in property_phrases.items():
+            self.property_matcher.add(self.lang.intern(phrase_tuple), captures)
+
+        self.property_matcher.compile()
+
+        # 5. build the transition graph for scripted flows: after an
+        # action rule with "expect:" or "next:" fires, the next stimulus
+        # gets matched first against only the responses it expects and
+        # the phrases which invoke its next rules
+
+        invokers = {}
+
+        for phrase_tuple, invoked in regex_phrases.items():
+            for r in invoked:
+                invokers.setdefault(r, []).append(phrase_tuple)
+
+        self.transitions = {}
+
+        for r in self.action_rules:
+            if r.expect_rules or r.next_rules:
+                self.transitions[r.name] = self.get_transition(r, invokers)
+
+        # 6. pack the text of all the rules into one string table, or
+        # into a fred_table.StringPool shared with other rulebases (in
+        # which case the pool stays out of this object, so that it can
+        # still be pickled)
+
+        table = fred_table.StringTable() if strings is None else strings.new_table()
+
+        for r in self.rule_dict.values():
+            r.vector = table.add(r.vector)
+
+        table.freeze()
+        self.strings = table if strings is None else None
+
+
+    def get_transition (self, rule, invokers):
+        """
+        the matcher for the stimuli which the given rule expects next,
+        and the rules which follow it in sequence
+        """
+
+        expected = {}
+
+        for response, action in rule.expect_rules:
+            for phrase in response.vector:
+                expected.setdefault(tuple(self.lang.parse(phrase)), []).append(action)
+
+        follow = rule.next_rules
+
+        for action in follow:
+            for phrase_tuple in invokers.get(action, ()):
+                expected.setdefault(phrase_tuple, []).append(action)
+
+        matcher = fred_match.PhraseMatcher()
+
+        for phrase_tuple, actions in expected.items():
+            if phrase_tuple:
+                matcher.add(self.lang.intern(phrase_tuple), tuple(dict.fromkeys(actions)))
+
+        return matcher.compile(), follow
+
+
+    def new_session (self, rng=None):
+        return fred_session.Session(self, rng)
+
+
+    def choose_first (self, session):
+        i = self.fire_action(session, self.first_action)
+        return self.render(self.first_action, i, ())
+
+
+    def fire_action (self, session, rule):
+        """
+        fire an action rule, returning the index of the chosen response
+        template
+        """
+
+        i = rule.pick(session)
+        session.last_action = rule.name
+        return i
+
+
+    def render (self, rule, i, stimulus):
+        """
+        fill in the "bind" slots of a response template, with whatever
+        follows the bind word in the stimulus (or the whole stimulus if
+        the rule was invoked without its bind word being said)
+        """
+
+        segments = rule.slots.get(i) if rule.slots else None
+
+        if not segments:
+            return rule.vector[i]
 
+        pos = self.lang.get_positions(stimulus).get(rule.bind)
+        fragment = stimulus if pos is None else stimulus[pos + 1:]
 
-    def choose_first (self):
-        return self.first_action.fire()
+        # 3.1 invert the verb tense, possessives, contractions, negations...
+        # NB: some kind of context-free grammar might work better here
+
+        replacement = " ".join(self.lang.invert(fragment))
+        return replacement.join(segments)
 
 
     @staticmethod
@@ -103,83 +271,326 @@ class Rules (object):
             return -1
 
 
-    def choose_rule (self, utterance):
+    def match_stimulus (self, stimulus, timer=None):
+        """
+        "Fred.chooseReply()" steps 2.1 and 2.2: the weighted action rules
+        invoked by key words in the stimulus, which depend on nothing but
+        the stimulus itself
+        """
+
+        candidates = []
+        token_ids = self.lang.encode(stimulus)
+
+        if timer:
+            timer.lap("tokenise")
+
+        #   2.1 regex matches => invoked action rules r=200
+        # NB: unknown words match nothing, and so reset the matcher
+
+        for rules in self.phrase_matcher.match(token_ids):
+            for rule in rules:
+                candidates.append((rule, 2.0))
+
+        if timer:
+            timer.lap("regex")
+
+        #   2.2 fuzzy rules => invoked action rules
+
+        for token_id in dict.fromkeys(token_ids):
+            members = self.fuzzy_sets.get(token_id)
+
+            if members:
+                rules, weights = members
+                candidates.extend(zip(rules, weights))
+
+        if timer:
+            timer.lap("fuzzy")
+
+        return candidates
+
+
+    def get_candidates (self, stimulus, timer=None):
+        """
+        match_stimulus, through the cache for short stimuli
+        """
+
+        cache = self.match_cache
+
+        if len(stimulus) > cache.max_tokens:
+            return self.match_stimulus(stimulus, timer)
+
+        key = tuple(stimulus)
+        candidates = cache.get(key)
+
+        if candidates is None:
+            candidates = tuple(self.match_stimulus(stimulus, timer))
+            cache.put(key, candidates)
+        elif timer:
+            timer.lap("tokenise")
+
+        return candidates
+
+
+    def get_expected (self, session, stimulus):
+        """
+        the candidates which the last action rule fired expects to come
+        next, if the stimulus is one of the responses it expects or
+        invokes one of its next rules; otherwise None, and the stimulus
+        gets matched against all the rules
+        """
+
+        transition = self.transitions.get(session.last_action)
+
+        if transition is None:
+            return None
+
+        matcher, follow = transition
+        return [(rule, 2.0) for actions in matcher.match(self.lang.encode(stimulus)) for rule in actions] or None
+
+
+    def mine_properties (self, session, stimulus):
+        """
+        set the session properties captured by "$property" phrases
+        """
+
+        cache = self.property_cache
+
+        if len(stimulus) > cache.max_tokens:
+            properties = self.match_properties(stimulus)
+        else:
+            key = tuple(stimulus)
+            properties = cache.get(key)
+
+            if properties is None:
+                properties = self.match_properties(stimulus)
+                cache.put(key, properties)
+
+        for name, value in properties:
+            session.properties[name] = value
+
+
+    def match_properties (self, stimulus):
+        """
+        the (property, value) pairs captured from the stimulus
+        """
+
+        properties = []
+
+        for captures in self.property_matcher.match(self.lang.encode(stimulus)):
+            for name, prefix, suffix in captures:
+                if prefix:
+                    pos = self.find_sublist(prefix, stimulus)
+                    value = stimulus[pos - 1 + len(prefix):]
+
+                    if suffix:
+                        end = self.find_sublist(suffix, value)
+
+                        if end > 0:
+                            value = value[:end - 1]
+                else:
+                    pos = self.find_sublist(suffix, stimulus)
+                    value = stimulus[:pos - 1]
+
+                if value:
+                    properties.append((name, " ".join(self.lang.invert(value))))
+
+        return tuple(properties)
+
+
+    def fill_properties (self, session, response):
+        return Rules.property_pat.sub(lambda m: session.properties.get(m.group(1).lower(), m.group(0)), response)
+
+
+    def choose_rule (self, session, utterance):
+        metrics = fred_metrics.active
+
+        if metrics is not None:
+            return self.choose_rule_measured(session, utterance, metrics)
+
         stimulus = self.lang.parse(utterance)
-        fuzzy_union = fred_fuzzy.FuzzyUnion()
+        candidates = self.get_expected(session, stimulus) or self.get_candidates(stimulus)
+        return self.reply(session, stimulus, candidates)
+
+
+    def choose_rule_measured (self, session, utterance, metrics):
+        """
+        choose_rule, counting the rule fired and, for a sample of the
+        turns, timing each stage
+        """
+
+        if metrics.sample():
+            start = fred_metrics.Stopwatch(metrics)
+            timer = fred_metrics.Stopwatch(metrics)
+
+            stimulus = self.lang.parse(utterance)
+            candidates = self.get_expected(session, stimulus) or self.get_candidates(stimulus, timer)
+            result = self.reply(session, stimulus, candidates, timer=timer)
+
+            start.lap("reply")
+        else:
+            stimulus = self.lang.parse(utterance)
+            candidates = self.get_expected(session, stimulus) or self.get_candidates(stimulus)
+            result = self.reply(session, stimulus, candidates)
+
+        metrics.count_fire(result[1])
+        metrics.match_cache = self.match_cache
+        return result
+
+
+    def reply (self, session, stimulus, candidates, fuzzy_union=None, timer=None):
+        """
+        choose and render a response, given the stimulus and its matched
+        candidates; a FuzzyUnion may be passed in for reuse, and a
+        fred_metrics.Stopwatch to time the stages
+        """
+
+        if fuzzy_union is None:
+            fuzzy_union = fred_fuzzy.FuzzyUnion()
+        else:
+            fuzzy_union.clear()
+
+        # 0. remember any properties the user has told us about
+
+        if self.property_matcher:
+            self.mine_properties(session, stimulus)
 
         # 1. select an optional introduction (p <= 0.03)
 
         response = ""
 
-        if random.random() < 0.03:
-            response = random.choice(self.intro_rules).fire()
+        if session.rng.random() < 0.03:
+            response = session.rng.choice(self.intro_rules).fire(session)
 
         # 2. "Fred.chooseReply()"
         # based on key words from the input stream
-        #   2.1 regex matches => invoked action rules r=200
 
-        for (phrase, rules) in self.regex_phrases.items():
-            if Rules.find_sublist(phrase, stimulus) >= 0:
-                for rule in rules:
-                    fuzzy_union.add_rule(rule, 2.0)
+        # NB: a rule which "requires:" a property may only fire once
+        # the session has that property
 
-        #   2.2 fuzzy rules => invoked action rules
-
-        for (fuzzy_term, members) in self.fuzzy_sets.items():
-            if fuzzy_term in stimulus:
-                for rule, weight in members:
-                    fuzzy_union.add_rule(rule, weight)
+        for rule, weight in candidates:
+            if rule.requires is None or rule.requires in session.properties:
+                fuzzy_union.add_rule(rule, weight)
 
-        #   2.3 action rules r=100
+        #   2.3 action rules r=100, starting with the rules which
+        #   follow the last one in sequence
 
-        if fuzzy_union.is_empty():
-            for rule in self.action_rules:
-                if rule.repeat or rule.count < 1:
+        if fuzzy_union.is_empty() and session.last_action in self.transitions:
+            for rule in self.transitions[session.last_action][1]:
+                if rule.requires is None or rule.requires in session.properties:
                     fuzzy_union.add_rule(rule, 1.0)
 
+        fallback = fuzzy_union.is_empty()
+
+        if fallback:
+            selected_rule, weight = self.choose_fallback(session, fuzzy_union)
+
+        if timer:
+            # the rules drawn from, after any fallback
+            timer.lap("fallback")
+            timer.metrics.candidates.observe(len(self.fallback_rules) if fallback else len(fuzzy_union.rules))
+
         # select an action rule to use for a response template
 
-        selected_rule, weight = fuzzy_union.select_rule()
-        response_template = selected_rule.fire()
+        if not fallback:
+            selected_rule, weight = fuzzy_union.select_rule(session.rng, session)
+
+        i = self.fire_action(session, selected_rule)
 
-        # 3. test for "bind" points in the selected response template
+        if timer:
+            timer.lap("select")
 
-        if selected_rule.bind and response_template.find("[]") > 0:
-            pos = stimulus.index(selected_rule.bind) + 1
-            fragment = stimulus[pos:]
+        # 3. fill in any "bind" points in the selected response template
 
-            # 3.1 invert the verb tense, possessives, contractions, negations...
-            # NB: some kind of context-free grammar might work better here
+        response += self.render(selected_rule, i, stimulus)
 
-            replacement = " ".join(self.lang.invert(fragment))
-            response_template = response_template.replace("[]", replacement)
+        if "$" in response:
+            response = self.fill_properties(session, response)
 
-        response += response_template
+        if timer:
+            timer.lap("render")
 
         # 4. decide whether the current query differs from the
-        # previous one...
+        # previous one: the selection above discounted the rules fired
+        # recently (see Session.record), so a repeated query tends to
+        # draw a different reply
 
-        # 5. "Fred.logChat()" keep track of what's been said
+        # 5. "Fred.logChat()" keep track of what's been said; the
+        # session has recorded the rule, and the caller, which knows
+        # how long the turn took, passes it on to a fred_log.TurnLog
 
         return response, selected_rule, weight
 
 
+    def choose_fallback (self, session, fuzzy_union):
+        """
+        draw a fallback rule, as the FuzzyUnion would from all of the
+        session's eligible fallback candidates at a weight of 1.0: draw
+        a priority group, then a rule within it, and keep the rule only
+        if it is eligible and survives its recency discount; so a turn
+        costs the same however many rules there are, unless most of the
+        draws miss, when the FuzzyUnion weighs every candidate after all
+        """
+
+        rng = session.rng
+        recent = session.recent
+        groups = self.fallback_groups
+        weights = self.fallback_weights
+
+        for n in range(self.fallback_tries):
+            group = groups[bisect.bisect_right(weights, rng.random() * weights[-1])]
+            rule = group[int(rng.random() * len(group))]
+
+            if not session.is_fallback(rule) or not (rule.requires is None or rule.requires in session.properties):
+                continue
+
+            if rule.name not in recent or rng.random() < session.discounts[session.turns - recent[rule.name]]:
+                return rule, 1.0
+
+        for rule in self.fallback_rules:
+            if session.is_fallback(rule) and (rule.requires is None or rule.requires in session.properties):
+                fuzzy_union.add_rule(rule, 1.0)
+
+        return fuzzy_union.select_rule(session.rng, session)
+
+
 class Rule (object):
     rule_pat = re.compile("(\S+)\:\s+(\S+)")
 
+    __slots__ = ("name", "vector", "id")
+
     def __init__ (self):
         self.name = None
         self.vector = None
-        self.count = 0
+        self.id = None
 
     def parse (self, name, vector, attrib):
-        self.name = name.lower()
+        self.name = sys.intern(name.lower())
         self.vector = vector
         return self
 
-    def fire (self):
-        self.count += 1
-        return random.choice(self.vector)
+    def link (self, rule_dict):
+        """
+        resolve the names this rule references into the rules themselves,
+        returning a list of problems
+        """
+
+        return []
+
+    @staticmethod
+    def resolve (rule_dict, name, kind, problems):
+        rule = rule_dict.get(name)
+
+        if rule is None:
+            problems.append("references unknown %s rule: %s" % (kind.__name__[:-4].lower(), name))
+        elif not isinstance(rule, kind):
+            problems.append("references %s, which is not a %s rule" % (name, kind.__name__[:-4].lower()))
+            rule = None
+
+        return rule
+
+    def fire (self, session):
+        session.record(self)
+        return session.rng.choice(self.vector)
 
 
     @staticmethod
@@ -206,10 +617,14 @@ class Rule (object):
             m = Rule.rule_pat.match(line)
 
             if m:
-                (elem, value) = m.group(1).lower().strip(), m.group(2).strip()
+                # the value runs to the end of the line, e.g. "invokes: A B"
+                (elem, value) = m.group(1).lower().strip(), line[m.end(1) + 1:].strip()
 
                 if not elem in ["priority", "requires", "equals", "bind", "invokes", "url", "next", "repeat", "expect"]:
                     raise ParseError("bad rule elem: " + elem)
+                elif elem in ["expect", "url"]:
+                    # these elements may be listed more than once
+                    attrib.setdefault(elem, []).append(value)
                 else:
                     attrib[elem] = value
             else:
@@ -232,50 +647,210 @@ class Rule (object):
     
 
     @staticmethod
-    def parse_file (lang, filename):
+    def parse_file (lang, filename, processes=None, progress=None):
         """
         read a JFRED rule file, return a Rules object 
         """
 
+        rule_dict, first_action, fuzzy_dict = Rule.read_file(filename, processes, progress)
+        return Rules(lang, rule_dict, first_action, fuzzy_dict)
+
+
+    @staticmethod
+    def iter_blocks (f):
+        """
+        stream the blocks of non-comment lines from a rule file opened in
+        binary mode, as (line number, lines) pairs, along with the count
+        of bytes read so far
+        """
+
+        rule_lines = []
+        start = 0
+        bytes_read = 0
+        line_number = 0
+
+        for raw in f:
+            bytes_read += len(raw)
+            line_number += 1
+            line = raw.decode("utf-8", "replace").strip()
+
+            if line.startswith("#"):
+                pass
+            elif len(line) == 0:
+                if len(rule_lines) > 0:
+                    yield start, rule_lines, bytes_read
+
+                rule_lines = []
+            else:
+                if not rule_lines:
+                    start = line_number
+
+                rule_lines.append(line)
+
+        # the last rule need not be followed by a blank line
+
+        if len(rule_lines) > 0:
+            yield start, rule_lines, bytes_read
+
+
+    @staticmethod
+    def parse_blocks (blocks):
+        """
+        parse a list of (line number, lines) blocks, returning (line
+        number, rule, error message) for each one
+        """
+
+        results = []
+
+        for line_number, rule_lines in blocks:
+            try:
+                results.append((line_number, Rule.parse_lines(list(rule_lines)), None))
+            except (ParseError, ValueError) as e:
+                message = "cannot parse rule description: %s %s" % (e, rule_lines)
+                results.append((line_number, None, message))
+
+        return results
+
+
+    @staticmethod
+    def iter_parsed (filename, processes=None, progress=None, chunk_size=500):
+        """
+        parse the blocks of a rule file in order, yielding (line number,
+        rule, error message) for each one; with processes > 1 chunks of
+        blocks get parsed in that many worker processes, while at most a
+        few chunks per worker are in flight, so memory stays bounded
+        """
+
+        total = os.path.getsize(filename)
+
+        with open(filename, "rb") as f:
+            chunks = Rule.iter_chunks(Rule.iter_blocks(f), chunk_size)
+
+            if not processes or processes < 2:
+                for chunk, bytes_read in chunks:
+                    for result in Rule.parse_blocks(chunk):
+                        yield result
+
+                    if progress:
+                        progress(bytes_read, total)
+
+                return
+
+            pending = collections.deque()
+
+            with multiprocessing.Pool(processes) as pool:
+                for chunk, bytes_read in chunks:
+                    pending.append((pool.apply_async(Rule.parse_blocks, (chunk,)), bytes_read))
+
+                    while len(pending) > processes * 2:
+                        async_result, done = pending.popleft()
+
+                        for result in async_result.get():
+                            yield result
+
+                        if progress:
+                            progress(done, total)
+
+                while pending:
+                    async_result, done = pending.popleft()
+
+                    for result in async_result.get():
+                        yield result
+
+                    if progress:
+                        progress(done, total)
+
+
+    @staticmethod
+    def iter_chunks (blocks, chunk_size):
+        chunk = []
+
+        for line_number, rule_lines, bytes_read in blocks:
+            chunk.append((line_number, rule_lines))
+
+            if len(chunk) >= chunk_size:
+                yield chunk, bytes_read
+                chunk = []
+
+        if chunk:
+            yield chunk, bytes_read
+
+
+    @staticmethod
+    def read_file (filename, processes=None, progress=None):
+        """
+        read a JFRED rule file, return the parsed rules before indexing;
+        raises RuleFileError listing every rule which failed to parse
+        """
+
+        parsed = []
+        errors = []
+
+        for line_number, rule, error in Rule.iter_parsed(filename, processes, progress):
+            if error:
+                errors.append((line_number, error))
+            else:
+                parsed.append((line_number, rule))
+
+        if errors:
+            raise RuleFileError(filename, errors)
+
+        return Rule.link_rules(filename, parsed)
+
+
+    @staticmethod
+    def link_rules (filename, parsed):
+        """
+        link the (line number, rule) pairs parsed from a rule file: give
+        each rule an integer ID, and resolve every rule it references by
+        name and kind; raises RuleFileError listing every duplicate name
+        and dangling reference
+        """
+
         rule_dict = {}
         first_action = None
         fuzzy_dict = {}
-        line_number = 0
+        lines = []
+        errors = []
 
-        with open(filename, "r") as f:
-            rule_lines = []
-
-            for line in f:
-                line = line.strip()
-
-                if line.startswith("#"):
-                    pass
-                elif len(line) == 0:
-                    if len(rule_lines) > 0:
-                        try:
-                            rule = Rule.parse_lines(rule_lines)
-                        except ParseError:
-                            print("ERROR: cannot parse rule description", line_number, rule_lines)
-                            sys.exit(1)
-                        else:
-                            if isinstance(rule, FuzzyRule):
-                                fuzzy_dict[rule.name] = rule
-                            else:
-                                rule_dict[rule.name] = rule
-
-                                if not first_action and isinstance(rule, ActionRule):
-                                    first_action = rule
-
-                    rule_lines = []
-                else:
-                    rule_lines.append(line)
+        # fuzzy rules are named for the word they test, so they have a
+        # namespace of their own
 
-                line_number += 1
+        for line_number, rule in parsed:
+            table = fuzzy_dict if isinstance(rule, FuzzyRule) else rule_dict
+            other = table.get(rule.name)
 
-        return Rules(lang, rule_dict, first_action, fuzzy_dict)
+            if other is not None:
+                errors.append((line_number, "duplicate name %s, already used at line %d" % (rule.name, lines[other.id])))
+                continue
+
+            rule.id = len(lines)
+            table[rule.name] = rule
+            lines.append(line_number)
+
+            if not first_action and isinstance(rule, ActionRule):
+                first_action = rule
+
+        for table in (rule_dict, fuzzy_dict):
+            for rule in table.values():
+                for problem in rule.link(rule_dict):
+                    errors.append((lines[rule.id], "%s: %s" % (rule.name, problem)))
+
+        if not first_action:
+            errors.append((0, "needs at least one action rule"))
+
+        if not any(isinstance(r, IntroRule) for r in rule_dict.values()):
+            errors.append((0, "needs at least one intro rule"))
+
+        if errors:
+            raise RuleFileError(filename, sorted(errors))
+
+        return rule_dict, first_action, fuzzy_dict
 
 
 class IntroRule (Rule):
+    __slots__ = ()
+
     def __init__ (self):
         super(IntroRule, self).__init__()
 
@@ -289,15 +864,20 @@ class IntroRule (Rule):
 
 
 class ActionRule (Rule):
+    __slots__ = ("priority", "repeat", "requires", "expect", "bind", "next", "url", "slots", "expect_rules", "next_rules")
+
     def __init__ (self):
         super(ActionRule, self).__init__()
         self.priority = 0
         self.repeat = False
         self.requires = None
-        self.expect = []
+        self.expect = ()
         self.bind = None
-        self.next = None
-        self.url = None
+        self.next = ()
+        self.url = ()
+        self.slots = None
+        self.expect_rules = ()
+        self.next_rules = ()
 
     def parse (self, name, vector, attrib):
         super(ActionRule, self).parse(name, vector, attrib)
@@ -315,19 +895,29 @@ class ActionRule (Rule):
             del attrib["requires"]
 
         if "expect" in attrib:
-            self.expect = attrib["expect"].lower().split(" ")
+            # each "expect:" names a response rule, and the action rule
+            # to fire when the next stimulus is one of those responses
+
+            for value in attrib["expect"]:
+                pair = tuple(value.lower().split())
+
+                if len(pair) != 2:
+                    raise ParseError("expect needs a response and an action rule: " + value)
+
+                self.expect += (pair,)
+
             del attrib["expect"]
 
         if "bind" in attrib:
-            self.bind = attrib["bind"].lower()
+            self.bind = sys.intern(attrib["bind"].lower())
             del attrib["bind"]
 
         if "next" in attrib:
-            self.next = attrib["next"].lower()
+            self.next = tuple(attrib["next"].lower().replace(",", " ").split())
             del attrib["next"]
 
         if "url" in attrib:
-            self.url = attrib["url"].lower()
+            self.url = tuple(url.lower() for url in attrib["url"])
             del attrib["url"]
 
         if len(attrib) > 0:
@@ -338,10 +928,54 @@ class ActionRule (Rule):
             # correct for missing "bind:" attributes
             self.bind = self.name
 
+        # split the response templates with "bind" points into literal
+        # segments, to be joined by the rephrased stimulus
+
+        self.slots = dict((i, tuple(t.split("[]"))) for i, t in enumerate(vector) if "[]" in t) or None
+
         return self
 
+    def link (self, rule_dict):
+        problems = []
+
+        if not self.vector:
+            problems.append("has no response templates")
+
+        expect_rules = []
+
+        for response_name, action_name in self.expect:
+            response = Rule.resolve(rule_dict, response_name, ResponseRule, problems)
+            action = Rule.resolve(rule_dict, action_name, ActionRule, problems)
+
+            if response and action:
+                expect_rules.append((response, action))
+
+        self.expect_rules = tuple(expect_rules)
+        self.next_rules = tuple(r for r in (Rule.resolve(rule_dict, name, ActionRule, problems) for name in self.next) if r)
+        return problems
+
+    def pick (self, session):
+        """
+        pick the responses in order, starting from a random one the
+        first time this rule fires within a session
+        """
+
+        session.record(self)
+        i = session.cursor.get(self.name)
+
+        if i is None:
+            i = session.rng.randrange(len(self.vector))
+
+        session.cursor[self.name] = (i + 1) % len(self.vector)
+        return i
+
+    def fire (self, session):
+        return self.vector[self.pick(session)]
+
 
 class ResponseRule (Rule):
+    __slots__ = ()
+
     def __init__ (self):
         super(ResponseRule, self).__init__()
 
@@ -355,9 +989,12 @@ class ResponseRule (Rule):
 
 
 class RegexRule (Rule):
+    __slots__ = ("invokes", "invoked")
+
     def __init__ (self):
         super(RegexRule, self).__init__()
         self.invokes = None
+        self.invoked = ()
 
     def parse (self, name, vector, attrib):
         super(RegexRule, self).parse(name, vector, attrib)
@@ -374,12 +1011,21 @@ class RegexRule (Rule):
 
         return self
 
+    def link (self, rule_dict):
+        problems = []
+        invoked = (Rule.resolve(rule_dict, name, ActionRule, problems) for name in self.invokes.split())
+        self.invoked = tuple(dict.fromkeys(r for r in invoked if r))
+        return problems
+
 
 class FuzzyRule (Rule):
+    __slots__ = ("weights", "members", "member_rules")
+
     def __init__ (self):
         super(FuzzyRule, self).__init__()
-        self.weights = []
+        self.weights = array.array("d")
         self.members = []
+        self.member_rules = ()
 
     def parse (self, name, vector, attrib):
         super(FuzzyRule, self).parse(name, vector, attrib)
@@ -391,15 +1037,24 @@ class FuzzyRule (Rule):
             weight, rule = line.split("\t")
             weight = float(int(weight))
 
-            self.members.append(rule.lower())
+            self.members.append(sys.intern(rule.lower()))
             self.weights.append(weight)
 
         sum_weight = sum(self.weights)
-        self.weights = list(map(lambda x: x / sum_weight, self.weights))
+
+        if sum_weight == 0:
+            raise ParseError("fuzzy rule weights must not sum to zero: " + name)
+
+        self.weights = array.array("d", [x / sum_weight for x in self.weights])
         self.vector = []
 
         return self
 
+    def link (self, rule_dict):
+        problems = []
+        self.member_rules = tuple(Rule.resolve(rule_dict, name, ActionRule, problems) for name in self.members)
+        return problems
+
 
 if __name__=='__main__':
     rule_dict, first_action = Rule.parse_file(sys.argv[1])
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import fred_metrics
+import fred_rules
+
+import asyncio
+import gc
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+
+######################################################################
+## server classes
+## an asyncio chat server, which keeps one session per connection and
+## serves many connections from a single process, plus a pre-fork
+## pool of those servers sharing one port
+######################################################################
+
+class AsyncServer (object):
+    max_line_size = 1024
+    backlog = 1024
+    idle_timeout = 300.0
+    write_buffer_size = 64 * 1024
+    shutdown_grace = 5.0
+    heartbeat_interval = 1.0
+
+    def __init__ (self, fred, port, host='', sock=None, heartbeat_fd=None):
+        self.fred = fred
+        self.port = port
+        self.host = host
+        self.sock = sock
+        self.heartbeat_fd = heartbeat_fd
+        self.heartbeat = None
+        self.server = None
+        self.clients = {}
+        self.stopping = None
+
+
+    async def write_line (self, writer, text):
+        """
+        send one line, waiting while the client's write buffer drains
+        """
+
+        writer.write(text.encode("utf-8"))
+        await writer.drain()
+
+
+    async def read_line (self, reader):
+        """
+        read one line from the client, or None when the client has left,
+        gone idle, or sent a line longer than max_line_size
+        """
+
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        except (asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            return None
+
+        if not line:
+            return None
+
+        return line.decode("utf-8", "replace").strip()
+
+
+    async def load_rules (self, tenant):
+        """
+        load the rules of a tenant in a worker thread, unless they are
+        loaded already, so that the other clients keep being served
+        """
+
+        registry = self.fred.registry
+
+        if registry and tenant is not None and not registry.is_loaded(tenant):
+            await asyncio.get_running_loop().run_in_executor(None, registry.get_rules, tenant)
+
+
+    async def handle (self, reader, writer):
+        """
+        converse with one client until it leaves
+        """
+
+        task = asyncio.current_task()
+        self.clients[task] = reader
+        writer.transport.set_write_buffer_limits(high=self.write_buffer_size)
+
+        try:
+            tenant = None
+
+            if self.fred.registry:
+                # the client names its tenant first
+                await self.write_line(writer, "tenant> ")
+                tenant = await self.read_line(reader)
+
+                if tenant not in self.fred.registry.tenants:
+                    await self.write_line(writer, "unknown tenant: %s\n" % tenant)
+                    return
+
+            key = None
+
+            if self.fred.store:
+                # then, optionally, the key of a session to carry on
+                await self.write_line(writer, "session> ")
+                key = await self.read_line(reader)
+
+            try:
+                await self.load_rules(tenant)
+                session = self.fred.new_session(tenant, key)
+            except (fred_rules.RuleFileError, OSError):
+                # the registry has logged why, once
+                await self.write_line(writer, "tenant unavailable: %s\n" % tenant)
+                return
+
+            await self.write_line(writer, session.rules.choose_first(session) + "\n> ")
+
+            while True:
+                utterance = await self.read_line(reader)
+
+                if not utterance:
+                    break
+
+                # the rules may have been evicted, or reloaded, meanwhile
+                try:
+                    await self.load_rules(tenant)
+                    response = self.fred.respond(session, utterance)
+                except (fred_rules.RuleFileError, OSError):
+                    await self.write_line(writer, "tenant unavailable: %s\n" % tenant)
+                    break
+                await self.write_line(writer, response + "\n> ")
+
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            del self.clients[task]
+            writer.close()
+
+
+    async def serve (self):
+        """
+        accept connections until asked to stop, then give the connected
+        clients a grace period to finish before closing them
+        """
+
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        if self.sock:
+            self.server = await asyncio.start_server(self.handle, sock=self.sock, limit=self.max_line_size)
+        else:
+            self.server = await asyncio.start_server(self.handle, self.host or None, self.port, limit=self.max_line_size, backlog=self.backlog)
+
+        if self.heartbeat_fd is not None:
+            self.heartbeat = asyncio.create_task(self.beat())
+
+        await self.stopping.wait()
+        self.server.close()
+
+        # idle clients see end-of-file, while any reply in flight still
+        # gets written out
+
+        for reader in self.clients.values():
+            reader.feed_eof()
+
+        if self.clients:
+            done, pending = await asyncio.wait(list(self.clients), timeout=self.shutdown_grace)
+
+            for task in pending:
+                task.cancel()
+
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        await self.server.wait_closed()
+
+
+    async def beat (self):
+        """
+        tell the parent process this event loop is still responsive
+        """
+
+        while True:
+            try:
+                os.write(self.heartbeat_fd, b".")
+            except OSError:
+                self.stop()
+                return
+
+            await asyncio.sleep(self.heartbeat_interval)
+
+
+    def stop (self):
+        if self.stopping:
+            self.stopping.set()
+
+
+    def run (self):
+        asyncio.run(self.serve())
+
+
+class WorkerPool (object):
+    heartbeat_timeout = 10.0
+    restart_delay = 1.0
+
+    def __init__ (self, fred, port, workers, host='', watcher=None, metrics_port=None):
+        self.fred = fred
+        self.watcher = watcher
+        self.metrics_port = metrics_port
+        self.port = port
+        self.host = host
+        self.num_workers = workers
+        self.workers = {}
+        self.running = False
+        self.sock = None
+
+
+    def listen (self):
+        """
+        return a listening socket for one worker; with SO_REUSEPORT each
+        worker binds its own and the kernel spreads the connections,
+        otherwise all of them share the one socket bound by the parent
+        """
+
+        if self.sock:
+            return self.sock
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if hasattr(socket, "SO_REUSEPORT"):
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        s.bind((self.host, self.port))
+        s.listen(AsyncServer.backlog)
+        s.setblocking(False)
+        return s
+
+
+    def spawn (self, slot):
+        """
+        fork one worker, which shares the parent's rules copy-on-write;
+        the worker in each slot serves its metrics on metrics_port + slot
+        """
+
+        beat_r, beat_w = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(beat_r)
+
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, signal.SIG_DFL)
+
+            status = 0
+
+            try:
+                # each worker needs its own random sequences, which with
+                # a seed stay the same from one run to the next
+                if self.fred.seed is not None:
+                    self.fred.seed = "%s/%d" % (self.fred.seed, slot)
+
+                # threads do not survive a fork, so each worker watches
+                # the rule file for itself
+                if self.watcher:
+                    self.watcher.start()
+
+                if self.fred.turn_log:
+                    self.fred.turn_log = self.fred.turn_log.clone(os.getpid())
+                    self.fred.turn_log.start()
+
+                if self.metrics_port is not None:
+                    fred_metrics.serve_metrics(self.metrics_port + slot)
+
+                server = AsyncServer(self.fred, self.port, self.host, sock=self.listen(), heartbeat_fd=beat_w)
+                server.run()
+            except Exception as e:
+                print("ERROR: worker", os.getpid(), "failed:", e, file=sys.stderr)
+                status = 1
+            finally:
+                # os._exit skips the usual cleanup, so write out the log first
+                if self.fred.turn_log:
+                    self.fred.turn_log.close()
+
+                if self.fred.store:
+                    self.fred.store.close()
+
+                os._exit(status)
+
+        os.close(beat_w)
+        os.set_blocking(beat_r, False)
+        self.workers[pid] = [beat_r, time.monotonic(), slot]
+        return pid
+
+
+    def retire (self, pid):
+        beat_r, last_beat, slot = self.workers.pop(pid)
+        os.close(beat_r)
+
+
+    def get_free_slots (self):
+        used = set(slot for beat_r, last_beat, slot in self.workers.values())
+        return [slot for slot in range(self.num_workers) if slot not in used]
+
+
+    def reap (self):
+        """
+        collect any workers which have exited
+        """
+
+        exited = []
+
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+
+            if pid == 0:
+                break
+
+            if pid in self.workers:
+                self.retire(pid)
+                exited.append(pid)
+
+        return exited
+
+
+    def check_health (self, timeout):
+        """
+        read the workers' heartbeats, and kill any worker which has gone
+        quiet for too long so that it gets restarted
+        """
+
+        pipes = dict((beat_r, pid) for pid, (beat_r, last_beat, slot) in self.workers.items())
+
+        try:
+            ready, _, _ = select.select(list(pipes), [], [], timeout)
+        except InterruptedError:
+            ready = []
+
+        now = time.monotonic()
+
+        for beat_r in ready:
+            pid = pipes[beat_r]
+
+            try:
+                if os.read(beat_r, 4096):
+                    self.workers[pid][1] = now
+            except OSError:
+                pass
+
+        for pid, (beat_r, last_beat, slot) in list(self.workers.items()):
+            if now - last_beat > self.heartbeat_timeout:
+                print("WARNING: worker", pid, "unresponsive, restarting", file=sys.stderr)
+                self.workers[pid][1] = now
+
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+
+    def stop (self, signum=None, frame=None):
+        self.running = False
+
+
+    def run (self):
+        """
+        keep the pool at full strength until asked to stop, then shut
+        the workers down gracefully
+        """
+
+        if hasattr(socket, "SO_REUSEPORT"):
+            # bind once up front, so a bad port fails here and not in
+            # every worker
+            self.listen().close()
+        else:
+            self.sock = self.listen()
+
+        # keep the garbage collector from touching (and so copying) the
+        # pages of the rules which every worker inherits
+        gc.collect()
+        gc.freeze()
+
+        self.running = True
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        for slot in self.get_free_slots():
+            self.spawn(slot)
+
+        while self.running:
+            self.check_health(AsyncServer.heartbeat_interval)
+
+            if self.reap() and self.running:
+                time.sleep(self.restart_delay)
+
+            for slot in self.get_free_slots():
+                if self.running:
+                    self.spawn(slot)
+
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + AsyncServer.shutdown_grace + 1.0
+
+        while self.workers and time.monotonic() < deadline:
+            if not self.reap():
+                time.sleep(0.1)
+
+        for pid in list(self.workers):
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self.retire(pid)
+
+
+if __name__=='__main__':
+    print(AsyncServer(None, 0))
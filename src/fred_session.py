@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import collections
+import itertools
+import random
+
+
+######################################################################
+## conversation state
+## everything that changes during a conversation lives here, so that
+## one parsed Rules object can be shared by many sessions and threads
+######################################################################
+
+class Session (object):
+    history_size = 32
+    session_ids = itertools.count(1)
+
+    # "rules are also discriminated against if they have been used
+    # recently": the share of its weight kept by a rule which fired n
+    # turns ago, recovering as n approaches history_size
+    discounts = [1.0 - 0.9 * 0.8 ** n for n in range(history_size + 1)]
+
+    def __init__ (self, rules, rng=None):
+        """
+        each session draws from a generator of its own, so that sessions
+        on different threads do not contend for one, and a session given
+        a seeded generator replies the same way on every run
+        """
+
+        self.id = next(Session.session_ids)
+        self.key = None
+        self.tenant = None
+        self.rules = rules
+        self.rng = rng or random.Random()
+        self.count = {}
+        self.cursor = {}
+        self.history = collections.deque(maxlen=Session.history_size)
+        self.recent = {}
+        self.turns = 0
+        self.last_action = None
+        self.properties = {}
+
+
+    def record (self, rule):
+        """
+        note that a rule has fired in this conversation; the history is
+        a ring of the last history_size rules fired, and recent maps
+        each rule within it to the turn when it last fired, so this
+        costs the same however many rules have fired before
+        """
+
+        self.count[rule.name] = self.count.get(rule.name, 0) + 1
+        self.turns += 1
+
+        if len(self.history) == Session.history_size:
+            # the oldest turn drops out of the window, along with its
+            # rule, unless that rule has fired again since
+            oldest = self.history[0]
+
+            if self.recent.get(oldest) == self.turns - Session.history_size:
+                del self.recent[oldest]
+
+        self.history.append(rule.name)
+        self.recent[rule.name] = self.turns
+
+
+    def get_count (self, rule):
+        return self.count.get(rule.name, 0)
+
+
+    def attach (self, rules):
+        """
+        carry this conversation over to a reloaded set of rules, keeping
+        the state of every rule whose name still exists
+        """
+
+        if rules is self.rules:
+            return
+
+        rule_dict = rules.rule_dict
+        self.count = dict((name, n) for name, n in self.count.items() if name in rule_dict)
+        self.cursor = dict((name, i % len(rule_dict[name].vector)) for name, i in self.cursor.items() if name in rule_dict and rule_dict[name].vector)
+        self.recent = dict((name, turn) for name, turn in self.recent.items() if name in rule_dict)
+
+        if self.last_action not in rule_dict:
+            self.last_action = None
+
+        self.rules = rules
+
+
+    def is_fallback (self, rule):
+        """
+        whether an action rule is still eligible as a fallback candidate:
+        a rule which may not repeat drops out once it has fired, which
+        the counts already tell, so the session keeps no list of its own
+        """
+
+        return rule.repeat or rule.name not in self.count
+
+
+if __name__=='__main__':
+    session = Session(None)
+    print(session.count, session.history)
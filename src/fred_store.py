@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import array
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import weakref
+import zlib
+
+
+######################################################################
+## session store
+## conversations which outlive the process serving them: the state of
+## a session gets packed into a few bytes of rule IDs and counters,
+## keyed by a name the client chooses, and comes back on a later
+## connection, after a restart, or in another worker process
+######################################################################
+
+class SessionStore (object):
+    magic = b"FS"
+    version = 1
+    header = struct.Struct("<2sBIIiIIII")
+    no_rule = 0xFFFFFFFF
+
+    def __init__ (self):
+        self.tables = weakref.WeakKeyDictionary()
+
+
+    def get_table (self, rules):
+        """
+        the rule IDs of a set of rules, and a signature of the names
+        behind them; states get stored by rule ID, so each signature's
+        names get stored alongside them, to map the IDs back by name
+        once the rules have changed
+        """
+
+        table = self.tables.get(rules)
+
+        if table is None:
+            names = [""] * (max([r.id for r in rules.rule_dict.values()] or [-1]) + 1)
+
+            for r in rules.rule_dict.values():
+                names[r.id] = r.name
+
+            names = "\n".join(names)
+            signature = zlib.crc32(names.encode("utf-8"))
+            ids = dict((r.name, r.id) for r in rules.rule_dict.values())
+            table = (signature, ids)
+
+            if self.get_names(signature) is None:
+                self.put_names(signature, names)
+
+            self.tables[rules] = table
+
+        return table
+
+
+    def encode (self, session):
+        """
+        pack the state of a session: a fixed header, then arrays of
+        (rule ID, count) and (rule ID, cursor) pairs and the history
+        of rule IDs, then the tenant and the properties as text
+        """
+
+        signature, ids = self.get_table(session.rules)
+        last_action = ids.get(session.last_action, -1)
+
+        counts = array.array("I")
+
+        for name, n in session.count.items():
+            counts.append(ids[name])
+            counts.append(n)
+
+        cursors = array.array("I")
+
+        for name, i in session.cursor.items():
+            cursors.append(ids[name])
+            cursors.append(i)
+
+        history = array.array("I", [ids.get(name, SessionStore.no_rule) for name in session.history])
+
+        text = [session.tenant or ""]
+
+        for name, value in session.properties.items():
+            text.append(name)
+            text.append(value)
+
+        text = "\0".join(text).encode("utf-8")
+
+        header = SessionStore.header.pack(SessionStore.magic, SessionStore.version, signature, session.turns, last_action, len(session.count), len(session.cursor), len(history), len(text))
+        return b"".join((header, counts.tobytes(), cursors.tobytes(), history.tobytes(), text))
+
+
+    def decode (self, state, rules, tenant=None):
+        """
+        unpack a state into a new session of the given tenant with the
+        given rules, or None if the state cannot be read, or belongs to
+        another tenant; rules which no longer exist get dropped, as they
+        do when a live session gets attached to rules which have been
+        reloaded
+        """
+
+        header_size = SessionStore.header.size
+
+        if len(state) < header_size:
+            return None
+
+        magic, version, signature, turns, last_action, n_counts, n_cursors, n_history, n_text = SessionStore.header.unpack_from(state)
+
+        if magic != SessionStore.magic or version != SessionStore.version:
+            return None
+
+        names = self.get_names(signature)
+
+        if names is None:
+            return None
+
+        names = names.split("\n")
+
+        if n_text > len(state) - header_size:
+            return None
+
+        # NB: a truncated or corrupted state raises ValueError here, or
+        # UnicodeDecodeError, which is one
+        try:
+            values = array.array("I")
+            values.frombytes(state[header_size:len(state) - n_text])
+            text = state[len(state) - n_text:].decode("utf-8").split("\0")
+        except ValueError:
+            return None
+
+        if len(values) != 2 * n_counts + 2 * n_cursors + n_history:
+            return None
+
+        if (text[0] or None) != tenant:
+            return None
+
+        if any(rule_id >= len(names) for rule_id in values[:2 * n_counts + 2 * n_cursors:2]):
+            return None
+
+        rule_dict = rules.rule_dict
+        session = rules.new_session()
+        session.tenant = tenant
+        session.turns = turns
+        session.properties = dict(zip(text[1::2], text[2::2]))
+
+        if 0 <= last_action < len(names) and names[last_action] in rule_dict:
+            session.last_action = names[last_action]
+
+        for k in range(0, 2 * n_counts, 2):
+            name = names[values[k]]
+
+            if name in rule_dict:
+                session.count[name] = values[k + 1]
+
+        for k in range(2 * n_counts, 2 * n_counts + 2 * n_cursors, 2):
+            name = names[values[k]]
+
+            if name in rule_dict and rule_dict[name].vector:
+                session.cursor[name] = values[k + 1] % len(rule_dict[name].vector)
+
+        # the history ends with the latest turn, so the turn when each
+        # rule in it last fired follows from its position
+        first_turn = turns - n_history + 1
+
+        for k, rule_id in enumerate(values[2 * n_counts + 2 * n_cursors:]):
+            name = names[rule_id] if rule_id < len(names) else ""
+            session.history.append(name)
+
+            if name in rule_dict:
+                session.recent[name] = first_turn + k
+
+        return session
+
+
+    @staticmethod
+    def get_key (key, tenant=None):
+        """
+        each tenant keeps its sessions apart, since any client may give
+        any key; a key comes from one line of input, so a newline cannot
+        be part of it
+        """
+
+        return key if tenant is None else "%s\n%s" % (tenant, key)
+
+
+    def save (self, key, session):
+        self.put(SessionStore.get_key(key, session.tenant), self.encode(session))
+
+
+    def load (self, key, rules, tenant=None):
+        """
+        the stored session of a tenant for a key, attached to the given
+        rules, or None if there is no such session
+        """
+
+        state = self.get(SessionStore.get_key(key, tenant))
+
+        if state is None:
+            return None
+
+        return self.decode(state, rules, tenant)
+
+
+    def close (self):
+        pass
+
+
+class MemoryStore (SessionStore):
+    """
+    sessions kept in this process, so they survive a client reconnecting,
+    but not a restart
+    """
+
+    def __init__ (self):
+        super(MemoryStore, self).__init__()
+        self.states = {}
+        self.names = {}
+
+
+    def get (self, key):
+        return self.states.get(key)
+
+
+    def put (self, key, state):
+        self.states[key] = state
+
+
+    def get_names (self, signature):
+        return self.names.get(signature)
+
+
+    def put_names (self, signature, names):
+        self.names[signature] = names
+
+
+class SQLiteStore (SessionStore):
+    """
+    sessions kept in a local SQLite file; saving a session only encodes
+    it and leaves it pending in memory, then a background thread writes
+    the pending sessions in one transaction per batch, so a session
+    which changes several times meanwhile only gets written once
+    """
+
+    flush_interval = 0.5
+    batch_size = 1000
+
+    def __init__ (self, filename):
+        super(SQLiteStore, self).__init__()
+        self.filename = filename
+        self.written = 0
+        self.pid = None
+        self.connection = None
+        self.writer = None
+
+
+    def open (self):
+        connection = sqlite3.connect(self.filename, timeout=30.0, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+
+    def connect (self):
+        """
+        open the database in this process; a forked worker gets its own
+        connection and writer thread, since neither survives a fork
+        """
+
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pending = {}
+            self.flushing = {}
+            self.lock = threading.Lock()
+            self.wake = threading.Event()
+            self.closing = False
+
+            self.connection = self.open()
+            self.connection.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, state BLOB NOT NULL, updated REAL NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS rule_names (signature INTEGER PRIMARY KEY, names TEXT NOT NULL)")
+
+            self.writer = threading.Thread(target=self.run, name="session-store", daemon=True)
+            self.writer.start()
+
+        return self.connection
+
+
+    def get (self, key):
+        connection = self.connect()
+
+        with self.lock:
+            # a session still waiting to be written is the latest one
+            state = self.pending.get(key) or self.flushing.get(key)
+
+            if state is not None:
+                return state
+
+            row = connection.execute("SELECT state FROM sessions WHERE key = ?", (key,)).fetchone()
+
+        return bytes(row[0]) if row else None
+
+
+    def put (self, key, state):
+        self.connect()
+
+        with self.lock:
+            self.pending[key] = state
+
+            if len(self.pending) >= self.batch_size:
+                self.wake.set()
+
+
+    def get_names (self, signature):
+        connection = self.connect()
+
+        with self.lock:
+            row = connection.execute("SELECT names FROM rule_names WHERE signature = ?", (signature,)).fetchone()
+
+        return row[0] if row else None
+
+
+    def put_names (self, signature, names):
+        connection = self.connect()
+
+        with self.lock:
+            connection.execute("INSERT OR REPLACE INTO rule_names (signature, names) VALUES (?, ?)", (signature, names))
+
+
+    def flush (self, connection):
+        """
+        write out the pending sessions through the writer's own
+        connection, so that loading a session never waits on the disk
+        """
+
+        with self.lock:
+            batch = self.flushing = self.pending
+            self.pending = {}
+
+        if not batch:
+            return
+
+        now = time.time()
+
+        try:
+            connection.execute("BEGIN")
+            connection.executemany("INSERT OR REPLACE INTO sessions (key, state, updated) VALUES (?, ?, ?)", [(key, state, now) for key, state in batch.items()])
+            connection.execute("COMMIT")
+            self.written += len(batch)
+        except sqlite3.Error as e:
+            print("WARNING: cannot write session store", self.filename, e, file=sys.stderr)
+
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+        finally:
+            with self.lock:
+                self.flushing = {}
+
+
+    def run (self):
+        """
+        write the pending sessions every flush_interval, or sooner once
+        a batch has built up, until the store gets closed
+        """
+
+        connection = self.open()
+
+        while not self.closing:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush(connection)
+
+        self.flush(connection)
+        connection.close()
+
+
+    def close (self):
+        """
+        write out everything still pending, then stop the writer
+        """
+
+        if self.pid != os.getpid():
+            return
+
+        self.closing = True
+        self.wake.set()
+        self.writer.join()
+        self.connection.close()
+        self.pid = None
+
+
+def open_store (filename):
+    """
+    a store for the given file, or one in memory for ":memory:"
+    """
+
+    if filename == ":memory:":
+        return MemoryStore()
+
+    return SQLiteStore(filename)
+
+
+if __name__=='__main__':
+    import fred_cache
+    import fred_lang
+
+    rules = fred_cache.load_rules(fred_lang.Language(), sys.argv[1])
+    store = open_store(sys.argv[2] if len(sys.argv) > 2 else ":memory:")
+
+    session = store.load("demo", rules) or rules.new_session()
+    print(rules.choose_rule(session, "hello")[0])
+    store.save("demo", session)
+    print(session.turns, "turns,", len(store.encode(session)), "bytes")
+    store.close()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import array
+import hashlib
+import threading
+import weakref
+
+
+######################################################################
+## compact storage
+## the text of all the rules packed into one string, with an array of
+## offsets, in place of a Python list of strings per rule
+######################################################################
+
+class StringTable (object):
+    def __init__ (self):
+        self.pending = []
+        self.text = ""
+        self.offsets = array.array("L", [0])
+
+
+    def add (self, strings):
+        """
+        append some strings, returning a TableVector over them; the
+        vector becomes readable once the table has been frozen
+        """
+
+        start = len(self.offsets) - 1 + len(self.pending)
+        self.pending.extend(strings)
+        return TableVector(self, start, start + len(strings))
+
+
+    def freeze (self):
+        """
+        pack the pending strings onto the end of the text
+        """
+
+        if self.pending:
+            offset = len(self.text)
+            offsets = self.offsets
+
+            for s in self.pending:
+                offset += len(s)
+                offsets.append(offset)
+
+            self.text += "".join(self.pending)
+            self.pending = []
+
+        return self
+
+
+    def get (self, i):
+        return self.text[self.offsets[i]:self.offsets[i + 1]]
+
+
+    def __len__ (self):
+        return len(self.offsets) - 1 + len(self.pending)
+
+
+class StringPool (object):
+    """
+    string storage shared between the rules of several rulebases: each
+    distinct rule vector gets packed once, keyed by a digest of its
+    text, and lives for as long as any rulebase still uses it
+    """
+
+    def __init__ (self):
+        self.segments = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def get_key (strings):
+        text = "%d\n%s" % (len(strings), "\n".join(strings))
+        return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+    def new_table (self):
+        """
+        a table for loading one rulebase into the pool
+        """
+
+        return PooledTable(self)
+
+
+    def get (self, key):
+        with self.lock:
+            return self.segments.get(key)
+
+
+    def put (self, vectors):
+        with self.lock:
+            for key, vector in vectors.items():
+                self.segments.setdefault(key, vector)
+
+
+    def __len__ (self):
+        return len(self.segments)
+
+
+class PooledTable (StringTable):
+    """
+    a string table which packs only the vectors its pool does not hold
+    yet, and hands back the pool's own vectors for the rest; the new
+    ones join the pool once the table has been frozen, and the table
+    lives for as long as any of them
+    """
+
+    def __init__ (self, pool):
+        super(PooledTable, self).__init__()
+        self.pool = pool
+        self.added = {}
+
+
+    def add (self, strings):
+        key = StringPool.get_key(strings)
+        vector = self.added.get(key)
+
+        if vector is None:
+            vector = self.pool.get(key)
+
+        if vector is None:
+            vector = self.added[key] = super(PooledTable, self).add(strings)
+
+        return vector
+
+
+    def freeze (self):
+        super(PooledTable, self).freeze()
+
+        # drop the pool, so that the rules can still be pickled
+        if self.pool is not None:
+            self.pool.put(self.added)
+            self.pool = None
+            self.added = {}
+
+        return self
+
+
+class TableVector (object):
+    """
+    a read-only sequence of strings stored within a StringTable
+    """
+
+    __slots__ = ("table", "start", "stop", "__weakref__")
+
+    def __init__ (self, table, start, stop):
+        self.table = table
+        self.start = start
+        self.stop = stop
+
+
+    def __len__ (self):
+        return self.stop - self.start
+
+
+    def __getitem__ (self, i):
+        n = self.stop - self.start
+
+        if i < 0:
+            i += n
+
+        if i < 0 or i >= n:
+            raise IndexError("vector index out of range")
+
+        return self.table.get(self.start + i)
+
+
+    def __iter__ (self):
+        for i in range(self.start, self.stop):
+            yield self.table.get(i)
+
+
+    def __repr__ (self):
+        return repr(list(self))
+
+
+if __name__=='__main__':
+    table = StringTable()
+    v = table.add(["Hi there.", "Greetings."])
+    table.freeze()
+    print(len(table), v, v[-1])
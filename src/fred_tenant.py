@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+## Python impl of JFRED, developed by Robby Garner and Paco Nathan
+## See: http://www.robitron.com/JFRED.php
+## 
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+## 
+##     http://www.apache.org/licenses/LICENSE-2.0
+## 
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import fred_lang
+import fred_rules
+import fred_table
+
+import collections
+import os
+import sys
+import threading
+
+
+######################################################################
+## multi-tenant rulebases
+## one engine serving several personalities, each tenant routed to its
+## own rule file; rulebases load on first use, the least recently used
+## get evicted, and the loaded ones share a vocabulary and the text of
+## any rules they have in common
+######################################################################
+
+class TenantRegistry (object):
+    max_loaded = 8
+
+    def __init__ (self, tenants, max_loaded=None, lang=None):
+        """
+        tenants maps each tenant key to its rule file; tenants with the
+        same rule file share one set of rules
+        """
+
+        self.tenants = dict(tenants)
+        self.max_loaded = max_loaded or TenantRegistry.max_loaded
+        self.lang = lang or fred_lang.Language()
+        self.strings = fred_table.StringPool()
+        self.loaded = collections.OrderedDict()
+        self.loading = {}
+        self.failed = {}
+        self.lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+
+    @staticmethod
+    def read_tenants (filename):
+        """
+        read a tenants file, with one "key rule_file" pair per line;
+        relative paths are taken from the directory of the tenants file
+        """
+
+        tenants = {}
+        base_dir = os.path.dirname(os.path.abspath(filename))
+
+        with open(filename, "r") as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.split("#", 1)[0].strip()
+
+                if not line:
+                    continue
+
+                fields = line.split()
+
+                if len(fields) != 2:
+                    raise ValueError("%s:%d: expected a tenant key and a rule file" % (filename, line_number))
+
+                rule_file = os.path.join(base_dir, fields[1])
+
+                if not os.path.isfile(rule_file):
+                    raise ValueError("%s:%d: no such rule file: %s" % (filename, line_number, rule_file))
+
+                tenants[fields[0]] = rule_file
+
+        return tenants
+
+
+    def get_rules (self, tenant):
+        """
+        the rules for a tenant, loading them on first use; raises
+        KeyError for an unknown tenant, or RuleFileError or OSError if
+        its rule file does not load, and then again without retrying
+        until the file changes
+        """
+
+        filename = self.tenants[tenant]
+
+        with self.lock:
+            rules = self.loaded.get(filename)
+
+            if rules is not None:
+                self.loaded.move_to_end(filename)
+                return rules
+
+            file_lock = self.loading.setdefault(filename, threading.Lock())
+
+        # load outside the registry lock, so that the other tenants keep
+        # being served meanwhile
+
+        with file_lock:
+            with self.lock:
+                rules = self.loaded.get(filename)
+                failure = self.failed.get(filename)
+
+            if rules is None:
+                mtime = TenantRegistry.get_mtime(filename)
+
+                if failure is not None and failure[0] == mtime:
+                    raise failure[1]
+
+                try:
+                    rules = self.load(filename)
+                except (fred_rules.RuleFileError, OSError) as e:
+                    print("WARNING: cannot load rules for", filename, e, file=sys.stderr)
+
+                    with self.lock:
+                        self.failed[filename] = (mtime, e)
+
+                    raise
+
+                with self.lock:
+                    self.failed.pop(filename, None)
+                    self.loaded[filename] = rules
+                    self.loads += 1
+
+                    while len(self.loaded) > self.max_loaded:
+                        self.loaded.popitem(last=False)
+                        self.evictions += 1
+
+        return rules
+
+
+    @staticmethod
+    def get_mtime (filename):
+        try:
+            return os.stat(filename).st_mtime_ns
+        except OSError:
+            return None
+
+
+    def is_loaded (self, tenant):
+        with self.lock:
+            return self.tenants[tenant] in self.loaded
+
+
+    def load (self, filename):
+        rule_dict, first_action, fuzzy_dict = fred_rules.Rule.read_file(filename)
+        return fred_rules.Rules(self.lang, rule_dict, first_action, fuzzy_dict, self.strings)
+
+
+    def invalidate (self, filename):
+        """
+        drop the rules loaded from a file, e.g. after it has changed;
+        the tenants' sessions move across on their next turn
+        """
+
+        with self.lock:
+            self.loaded.pop(filename, None)
+
+
+    def new_session (self, tenant, rng=None):
+        rules = self.get_rules(tenant)
+        session = rules.new_session(rng)
+        session.tenant = tenant
+        return session
+
+
+if __name__=='__main__':
+    registry = TenantRegistry(TenantRegistry.read_tenants(sys.argv[1]))
+
+    for tenant in registry.tenants:
+        session = registry.new_session(tenant)
+        print(tenant, session.rules.choose_first(session))
+
+    print(len(registry.loaded), "loaded,", len(registry.strings), "shared text segments")
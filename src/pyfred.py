@@ -17,28 +17,145 @@
 ## limitations under the License.
 
 
+import fred_cache
 import fred_client
 import fred_lang
+import fred_log
+import fred_metrics
+import fred_reload
 import fred_rules
+import fred_server
+import fred_store
+import fred_tenant
 
-import random
+import argparse
 import sys
 
 
+def parse_args ():
+    parser = argparse.ArgumentParser(description="JFRED chatbot engine")
+    parser.add_argument("rule_file", nargs="?", help="JFRED rule file")
+    parser.add_argument("port", type=int, nargs="?", help="serve chats through a TCP socket on this port")
+    parser.add_argument("--tenants", help="serve several rule files, one per tenant, as listed in this file of \"tenant rule_file\" lines")
+    parser.add_argument("--max-loaded", type=int, default=fred_tenant.TenantRegistry.max_loaded, help="the most tenants' rule files to keep loaded at once")
+    parser.add_argument("--parse-processes", type=int, default=0, help="parse the rule file in this many worker processes")
+    parser.add_argument("--progress", action="store_true", help="report progress while parsing the rule file")
+    parser.add_argument("--compile", action="store_true", help="compile the rule file into its cache, then exit")
+    parser.add_argument("--no-cache", action="store_true", help="always parse the rule file, ignoring its compiled cache")
+    parser.add_argument("--watch", action="store_true", help="reload the rule file whenever it changes, keeping the live conversations")
+    parser.add_argument("--blocking", action="store_true", help="serve one TCP client at a time, instead of through asyncio")
+    parser.add_argument("--workers", type=int, default=0, help="serve TCP clients from this many forked worker processes")
+    parser.add_argument("--log", help="log each turn to this JSONL file, gzip compressed if it ends in .gz")
+    parser.add_argument("--log-block", action="store_true", help="make replies wait when the turn log falls behind, rather than dropping turns")
+    parser.add_argument("--sessions", help="keep sessions in this SQLite file (or \":memory:\"), so that a client giving a session key carries on its conversation")
+    parser.add_argument("--metrics-port", type=int, help="serve reply metrics over HTTP on this local port (one port per worker, counting up)")
+    parser.add_argument("--metrics-sample", type=int, default=1, help="time the stages of one turn in every N")
+    parser.add_argument("--seed", help="seed each session's random choices, so that runs can be replayed")
+    parser.add_argument("--idle-timeout", type=float, default=fred_server.AsyncServer.idle_timeout, help="seconds before an idle TCP client gets disconnected")
+
+    args = parser.parse_args()
+
+    if args.tenants and args.port is None and args.rule_file and args.rule_file.isdigit():
+        # with --tenants there is no rule file, so a lone argument is the port
+        args.port, args.rule_file = int(args.rule_file), None
+
+    if not args.rule_file and not args.tenants:
+        parser.error("a rule file or --tenants is required")
+
+    if args.tenants and (args.rule_file or args.compile or args.watch):
+        parser.error("--tenants replaces the rule file, --compile and --watch")
+
+    return args
+
+
+def show_progress (bytes_read, total):
+    sys.stderr.write("\rparsed %3d%%" % (100 * bytes_read // max(total, 1)))
+
+    if bytes_read >= total:
+        sys.stderr.write("\n")
+
+
 if __name__=='__main__':
-    if len(sys.argv) < 2:
-        ## CLI error, show usage
-        sys.exit("usage:\n  %s rule_file [port]" % sys.argv[0])
+    args = parse_args()
 
-    random.seed()
     lang = fred_lang.Language()
-    rules = fred_rules.Rule.parse_file(lang, sys.argv[1])
-    fred = fred_client.FRED(rules)
-
-    if len(sys.argv) < 3:
-        ## test from CLI
-        fred.chat(fred_client.Convo())
-    else:
-        ## connect through TCP socket
-        port = int(sys.argv[2])
-        fred.chat_tcp(port)
+
+    progress = show_progress if args.progress else None
+
+    rules = None
+    registry = None
+
+    try:
+        if args.tenants:
+            ## load each tenant's rules on first use
+            registry = fred_tenant.TenantRegistry(fred_tenant.TenantRegistry.read_tenants(args.tenants), args.max_loaded, lang)
+        elif args.compile:
+            ## build the compiled rulebase cache
+            rules = fred_rules.Rule.parse_file(lang, args.rule_file, args.parse_processes, progress)
+            fred_cache.RuleCache(args.rule_file).save(rules)
+            sys.exit(0)
+        else:
+            rules = fred_cache.load_rules(lang, args.rule_file, not args.no_cache, args.parse_processes, progress)
+    except (fred_rules.RuleFileError, OSError, ValueError) as e:
+        print("ERROR:", e, file=sys.stderr)
+        sys.exit(1)
+
+    turn_log = None
+
+    if args.log:
+        try:
+            turn_log = fred_log.TurnLog(args.log, block=args.log_block)
+        except OSError as e:
+            print("ERROR:", e, file=sys.stderr)
+            sys.exit(1)
+
+    store = None
+
+    if args.sessions:
+        store = fred_store.open_store(args.sessions)
+
+    fred = fred_client.FRED(rules, turn_log, registry, store, args.seed)
+
+    if args.metrics_port is not None:
+        fred_metrics.enable(args.metrics_sample)
+    watcher = None
+
+    if args.watch:
+        watcher = fred_reload.RuleWatcher(fred, lang, args.rule_file, use_cache=not args.no_cache)
+
+        if args.port is None or args.blocking or args.workers < 1:
+            watcher.start()
+
+    if args.port is not None and args.workers > 0:
+        ## serve TCP clients from a pool of worker processes, each of
+        ## which writes its own turn log
+        fred_server.AsyncServer.idle_timeout = args.idle_timeout
+        fred_server.WorkerPool(fred, args.port, args.workers, watcher=watcher, metrics_port=args.metrics_port).run()
+        sys.exit(0)
+
+    if turn_log:
+        turn_log.start()
+
+    if args.metrics_port is not None:
+        fred_metrics.serve_metrics(args.metrics_port)
+
+    try:
+        if args.port is None:
+            ## test from CLI
+            fred.chat(fred_client.Convo())
+        elif args.blocking:
+            ## connect through TCP socket, one client at a time
+            fred.chat_tcp(args.port)
+        else:
+            ## serve many TCP clients concurrently
+            server = fred_server.AsyncServer(fred, args.port)
+            server.idle_timeout = args.idle_timeout
+            server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if turn_log:
+            turn_log.close()
+
+        if store:
+            store.close()